@@ -1,9 +1,24 @@
+import collections
 import json
 import os
 import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import cherrypy
+from addons.camera.characterization import CharacterizationFile
+from addons.camera.controller import SpotController
 from addons.camera.deviation import Deviation
+from addons.camera.framesource import FrameGrabber, open_source
+from addons.camera.lookup import get_lookup, pin_values
+from modules.plugin_serialobject import PRIORITY_BULK
+
+# mount point, text shown in the main ui and static folder, read by the app
+# without importing the addon
+ADDON_CONF = {'url': '/camera', 'text': 'Camera control', 'static': 'static'}
+# points of a characterization captured ahead of their processing at most
+PIPELINE_DEPTH = 2
 
 
 class AppAddon(object):
@@ -17,11 +32,8 @@ class AppAddon(object):
         `url` is the mount point in the app.
         `text` is the displayed text in the main ui.
         """
-        self.addon_conf = {
-            'url': '/camera',
-            'text': 'Camera control'
-        }
-        ppath = os.path.join(addon_path, 'static')
+        self.addon_conf = ADDON_CONF
+        ppath = os.path.join(addon_path, ADDON_CONF['static'])
         self.cpconf = {
             '/': {
                 'tools.staticdir.root': os.path.abspath(os.getcwd())
@@ -36,9 +48,22 @@ class AppAddon(object):
         self.calib_file = os.path.join(ppath, calib_file)
         self.proc_file = os.path.join(ppath, proc_file)
         self.static_path = ppath
+        self.addon_path = addon_path
+        # frame source kept open between captures, and its device
+        self.source = None
+        self.source_device = None
+        # streaming mode: grabbing thread, spot finding thread and its result
+        self.grabber = None
+        self.stream_result = None
+        self._stream_thread = None
+        self._stream_stop = threading.Event()
+        # serializes the use of the deviation object between request threads
+        self.lock = threading.RLock()
+        self._source_lock = threading.Lock()
+        cherrypy.engine.subscribe('stop', self.close_source)
         try:
-            self.deviation = Deviation(self.calib_file, addon_path)
-            self.deviation.load_image(self.image_file)
+            self.deviation = Deviation(self.calib_file, addon_path,
+                                       tracking=True)
         except Exception as e:
             cherrypy.engine.log('ERROR '+str(e))
 
@@ -46,10 +71,42 @@ class AppAddon(object):
     def index(self):
         return open(self.html_file)
 
+    def open_source(self, device):
+        """Source of `device`, opened on first use. See `open_source` for the
+        accepted devices.
+        """
+        if self.source is None or self.source_device != device:
+            self.close_source()
+            self.source = open_source(device, self.addon_path)
+            self.source_device = device
+        return self.source
+
+    def frame(self, device):
+        """Grab a frame. While streaming, it is the first frame taken after the
+        call, and `device` is ignored.
+        """
+        if self.grabber is not None:
+            return self.grabber.latest(since=time.time())[2]
+        with self._source_lock:
+            return self.open_source(device).grab()
+
+    def grab(self, device):
+        """Grab a frame into the deviation object."""
+        self.deviation.image = self.frame(device)
+
+    def close_source(self):
+        self.stream_stop()
+        if self.source is not None:
+            self.source.close()
+            self.source = None
+            self.source_device = None
+
     @cherrypy.expose
     def capture(self, device):
         try:
-            self.deviation.capture(self.image_file, device)
+            with self.lock:
+                self.grab(device)
+                self.deviation.save_image(self.image_file)
         except Exception as e:
             return {'success': False, 'info': str(e), 'data': None}
         return {'success': True}
@@ -75,19 +132,26 @@ class AppAddon(object):
     @cherrypy.expose
     @cherrypy.tools.json_out()
     def process(self, spotsize=15):
-        return self.findspot(int(spotsize))
+        with self.lock:
+            # the last capture, when nothing was grabbed since the start
+            if self.deviation.image is None:
+                self.deviation.load_image(self.image_file)
+            return self.findspot(int(spotsize))
 
     @cherrypy.expose
     @cherrypy.tools.json_out()
     def capture_and_process(self, device, spotsize=15):
-        try:
-            self.deviation.capture(self.image_file, device)
-        except Exception as e:
-            return {'success': False, 'info': str(e), 'data': None}
-        return self.findspot(int(spotsize))
+        with self.lock:
+            try:
+                self.grab(device)
+                self.deviation.save_image(self.image_file)
+            except Exception as e:
+                return {'success': False, 'info': str(e), 'data': None}
+            return self.findspot(int(spotsize))
 
     def findspot(self, spotsize):
-        coords = self.deviation.findspot(self.proc_file, spotsize)
+        with self.lock:
+            coords = self.deviation.findspot(self.proc_file, spotsize)
         if coords:
             data = '({:.4},{:.4})'.format(*coords)
             return {'success': True, 'info': 'OK', 'data': data}
@@ -96,10 +160,200 @@ class AppAddon(object):
 
     @cherrypy.expose
     @cherrypy.tools.json_out()
-    def characterize(self, device, distance, gridsize, steps, radii,
-                     spotsize=15, pins=(3, 9, 10, 11), settling=250):
+    def lookup(self, x, y, apply='false', settling=0,
+               path='characterization.jsonl'):
+        """PWM values that put the spot at the grid coordinates (x, y),
+        interpolated from the characterization in `path`, and set them on the
+        board if `apply` is 'true', returning `settling` milis after.
+
+        Returns as data the `pins`, their `values`, and the `distance` from
+        (x, y) to the nearest measured spot.
+        """
+        try:
+            pins, values, distance = get_lookup(path).values(float(x),
+                                                             float(y))
+        except (OSError, ValueError) as e:
+            return {'success': False, 'info': str(e), 'data': None}
+        data = {'pins': pins, 'values': values, 'distance': distance}
+        if apply == 'true':
+            res = cherrypy.engine.publish(
+                'serial-write', ['vset', pins, values])[0]
+            if not res['success']:
+                return {'success': False, 'info': res['info'], 'data': data}
+            time.sleep(int(settling) / 1000)
+        return {'success': True, 'info': None, 'data': data}
+
+    @cherrypy.expose
+    @cherrypy.tools.json_in()
+    @cherrypy.tools.json_out()
+    def goto(self):
+        """Start a job bringing the spot to a target with camera feedback.
+        Takes the arguments of `_goto` as json input, and returns the job id
+        as data. Every iteration is reported as a partial result of the job.
+        """
+        kwargs = cherrypy.request.json
+        job_id = cherrypy.engine.publish('job-submit', 'goto', self._goto,
+                                         **kwargs)[0]
+        return {'success': True, 'data': {'job': job_id},
+                'info': 'Positioning started'}
+
+    def _goto(self, job, device, x, y, spotsize=15, settling=50,
+              path='characterization.jsonl', **params):
+        """Bring the spot to the grid coordinates (x, y) with a
+        `SpotController`, starting from the characterization in `path` if it
+        exists.
+
+        Args:
+            job (Job): handle of the running job
+            device (str): device name, see `open_source`
+            settling (int): milis to wait after every vset
+            params: gain, max_step, tolerance, deadline, budget and probe of
+                the controller
+
+        Returns:
+            the controller result, see `SpotController.run`
+        """
+        x, y, spotsize = float(x), float(y), int(spotsize)
+        lookup = get_lookup(path)
+        try:
+            lookup.query(x, y)
+        except (OSError, ValueError):
+            lookup = None
+        pins = lookup.pins if lookup else (3, 9, 10, 11)
+
+        def apply(valx, valy):
+            res = cherrypy.engine.publish(
+                'serial-write', ['vset', pins, pin_values(valx, valy)])[0]
+            if not res['success']:
+                raise RuntimeError(res['info'])
+            time.sleep(settling / 1000)
+
+        def locate():
+            return self._locate(self.frame(device), spotsize)[0]
+
+        controller = SpotController(apply, locate, lookup, **params)
+        return controller.run(x, y, job.cancelled,
+                              lambda state: job.report(None, state))
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def stream_start(self, device, rate=10, spotsize=15):
+        """Start grabbing frames from `device` continuously, and finding the
+        spot on the newest one `rate` times per second. Each result is
+        published on the 'camera-spot' channel, and returned by `latest`.
+        With a rate of 0, the spot is found only when `latest` is requested.
+
+        While streaming, captures and characterizations use the grabbed
+        frames.
+        """
+        rate, spotsize = float(rate), int(spotsize)
+        self.stream_stop()
+        try:
+            self.grabber = FrameGrabber(self.open_source(device))
+        except Exception as e:
+            return {'success': False, 'info': str(e), 'data': None}
+        self.grabber.start()
+        if rate > 0:
+            self._stream_stop.clear()
+            self._stream_thread = threading.Thread(
+                target=self._stream_loop, args=(rate, spotsize),
+                name='camera-stream')
+            self._stream_thread.daemon = True
+            self._stream_thread.start()
+        return {'success': True, 'info': 'Streaming', 'data': None}
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def stream_stop(self):
+        self._stream_stop.set()
+        if self._stream_thread is not None:
+            self._stream_thread.join()
+            self._stream_thread = None
+        if self.grabber is not None:
+            self.grabber.stop()
+            self.grabber = None
+        self.stream_result = None
+        return {'success': True, 'info': 'Stopped', 'data': None}
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def latest(self, spotsize=15):
+        """Spot found on the newest frame of the stream, as a dict with the
+        frame number and time, its `coords` (None if not found), the search
+        `path` used and the `latency` from the frame grab to the result.
+
+        The spot is searched now if the stream runs with a rate of 0.
+        """
+        if self.grabber is None:
+            return {'success': False, 'info': 'Not streaming', 'data': None}
+        result = self.stream_result
+        if self._stream_thread is None:
+            try:
+                result = self._find_latest(int(spotsize))
+            except IOError as e:
+                return {'success': False, 'info': str(e), 'data': None}
+        if result is None:
+            return {'success': False, 'info': 'No frame yet', 'data': None}
+        return {'success': result['coords'] is not None, 'data': result,
+                'info': None if result['coords'] else 'Spot not found'}
+
+    def _find_latest(self, spotsize, after=None):
+        count, stamp, frame = self.grabber.latest(after=after)
+        with self.lock:
+            self.deviation.image = frame
+            coords = self.deviation.findspot(None, spotsize)
+            path = self.deviation.last_path
+        return {'frame': count, 'time': stamp, 'path': path,
+                'coords': [float(c) for c in coords] if coords else None,
+                'latency': time.time() - stamp}
+
+    def _locate(self, frame, spotsize):
+        """Spot coordinates in `frame` without plotting, retrying with a 50%
+        bigger spot size if not found, and whether the first try found it.
+        """
+        with self.lock:
+            self.deviation.image = frame
+            coords = self.deviation.findspot(None, spotsize)
+            if coords is not None:
+                return coords, True
+            return self.deviation.findspot(None, round(1.5*spotsize)), False
+
+    def _stream_loop(self, rate, spotsize):
+        count = None
+        while not self._stream_stop.is_set():
+            start = time.time()
+            try:
+                result = self._find_latest(spotsize, after=count)
+            except IOError as e:
+                if self.grabber.error is not None:
+                    cherrypy.engine.log('ERROR ' + str(e))
+                    break
+                continue
+            count = result['frame']
+            self.stream_result = result
+            _ = cherrypy.engine.publish('camera-spot', result)
+            self._stream_stop.wait(1 / rate - (time.time() - start))
+
+    @cherrypy.expose
+    @cherrypy.tools.json_in()
+    @cherrypy.tools.json_out()
+    def characterize(self):
+        """Start a characterization job. Takes the arguments of
+        `_characterize` as json input, and returns the job id as data. The
+        progress and partial results are available through `/jobStatus`.
+        """
+        kwargs = cherrypy.request.json
+        job_id = cherrypy.engine.publish('job-submit', 'characterize',
+                                         self._characterize, **kwargs)[0]
+        return {'success': True, 'data': {'job': job_id},
+                'info': 'Characterization started'}
+
+    def _characterize(self, job, device, distance, gridsize, steps, radii,
+                      spotsize=15, pins=(3, 9, 10, 11), settling=250,
+                      resume=False, output='characterization.jsonl'):
         """Characterize voltage vs. deviation coords automatically. The result
-        is stored in a file called `characterization.json`.
+        is appended point by point to the file `output`, see
+        `CharacterizationFile`.
 
         This method assumes that the calibration is already loaded.
 
@@ -107,50 +361,78 @@ class AppAddon(object):
         that were not recognized with the requested `spotsize` have a value
         `isok` False.
 
-        WARNING: It is quite blocking due to the settling waiting time and the
-        possibly long loop.
+        Every measured point is reported to `job` as a partial result, and
+        the loop stops early if the job is cancelled.
 
-        TODO: find a better implementation to avoid blocking the server.
+        Points are processed on a worker thread while the next one settles
+        and is captured, and reported in order.
 
         Args:
-            device (str): device name
+            job (Job): handle of the running job
+            device (str): device name, see `open_source`
             steps (int):  number of divisions of 360º
             radii (float list): sequence of numbers between 0..1
             pins (int list): pin correspondance (right top left bottom)
+            resume (bool): skip the points already in `output`, if it holds
+                a characterization with the same rect and parameters
+            output (str): path of the result file
 
         Returns:
-            list of (radius,xgrid,ygrid,xcoord,ycoord,isok)
+            dict with the `file` and its number of `points`
         """
-        dev = self.deviation
-        data = []
-        for radius in radii:
-            for k in range(steps):
-                valx = radius*math.cos(k*2*math.pi/steps)
-                valy = radius*math.sin(k*2*math.pi/steps)
-                values = [0, 0, 0, 0]
-                i = 0 if valx > 0 else 2
-                j = 1 if valy > 0 else 3
-                values[i] = int(abs(valx))
-                values[j] = int(abs(valy))
-                res = cherrypy.engine.publish('serial-write',
-                                              ['vset', pins, values, settling])
-                if not res['success']:
-                    # data.append((radius,valx,valy,None,None,False))
-                    # continue
-                    return res
-                # capture image and find the spot coordinates without plotting
-                dev.capture(self.image_file, device)
-                coords = dev.findspot(None, spotsize)
-                # another try with 50% bigger spotsize
-                if not coords:
-                    coords = dev.findspot(None, round(1.5*spotsize))
-                    if not coords:
-                        data.append((radius, valx, valy, None, None, False))
-                    else:
-                        data.append((radius, valx, valy,
-                                    coords[0], coords[1], False))
-                    continue
-                data.append((radius, valx, valy, coords[0], coords[1], True))
-        with open('characterization.json', 'w') as f:
-            json.dump(data, f)
-        return {'success': True, 'data': data, 'info': 'Characterization'}
+        steps = int(steps)
+        spotsize = int(spotsize)
+        total = len(radii) * steps
+        params = {'distance': distance, 'gridsize': gridsize, 'steps': steps,
+                  'radii': list(radii), 'spotsize': spotsize,
+                  'pins': list(pins), 'settling': settling}
+        rect = [list(corner) for corner in self.deviation.rect]
+        with CharacterizationFile(output) as store:
+            store.open(rect, params, resume)
+            self._characterize_points(job, store, device, steps, radii,
+                                      spotsize, pins, settling, total)
+            return {'file': output, 'points': store.count}
+
+    def _characterize_points(self, job, store, device, steps, radii, spotsize,
+                             pins, settling, total):
+        # points captured and being processed, oldest first
+        pending = collections.deque()
+
+        def finish():
+            radius, valx, valy, future = pending.popleft()
+            coords, isok = future.result()
+            if not coords:
+                row = (radius, valx, valy, None, None, False)
+            else:
+                row = (radius, valx, valy, coords[0], coords[1], isok)
+            store.append(row)
+            job.report(store.count / total, row)
+
+        with ThreadPoolExecutor(max_workers=1) as worker:
+            for radius in radii:
+                for k in range(steps):
+                    if job.cancelled():
+                        break
+                    valx = radius*math.cos(k*2*math.pi/steps)
+                    valy = radius*math.sin(k*2*math.pi/steps)
+                    values = pin_values(valx, valy)
+                    if store.is_measured(radius, valx, valy):
+                        continue
+                    res = cherrypy.engine.publish(
+                        'serial-write', ['vset', pins, values],
+                        PRIORITY_BULK)[0]
+                    if not res['success']:
+                        # keep the points already captured
+                        while pending:
+                            finish()
+                        raise RuntimeError(res['info'])
+                    # the spot of the previous point is found meanwhile
+                    time.sleep(settling / 1000)
+                    frame = self.frame(device)
+                    pending.append((radius, valx, valy, worker.submit(
+                        self._locate, frame, spotsize)))
+                    while pending and (pending[0][3].done() or
+                                       len(pending) > PIPELINE_DEPTH):
+                        finish()
+            while pending:
+                finish()
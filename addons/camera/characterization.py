@@ -0,0 +1,110 @@
+import json
+import os
+
+# first line of the file, followed by one line per measured point
+FORMAT_VERSION = 1
+# parameters that must match to resume a characterization
+RESUME_KEYS = ('steps', 'radii', 'pins', 'spotsize')
+
+
+class CharacterizationFile(object):
+    """Append-only storage of a characterization, in JSON lines.
+
+    The first line is a header with the calibration rect and the parameters,
+    then every point is a line (radius,xgrid,ygrid,xcoord,ycoord,isok) written
+    as soon as it is measured, so an interrupted run keeps what it measured
+    and can be resumed.
+
+    Usage:
+        with CharacterizationFile(path) as store:
+            store.open(rect, params, resume=True)
+            if store.is_measured(radius, xgrid, ygrid): ...
+            store.append(row)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.header = None
+        self.count = 0
+        self._measured = set()
+        self._file = None
+
+    def open(self, rect, params, resume=False):
+        """Start a new file, or continue the existing one if `resume` and it
+        was started with the same rect and parameters.
+
+        Raises:
+            ValueError: if resuming a file of a different characterization
+        """
+        header = {'version': FORMAT_VERSION, 'rect': rect, 'params': params}
+        if resume and os.path.exists(self.path):
+            old = self._load()
+            if old is not None:
+                mismatch = [key for key in RESUME_KEYS
+                            if old['params'].get(key) != params.get(key)]
+                if old['rect'] != rect:
+                    mismatch.append('rect')
+                if mismatch:
+                    raise ValueError('Cannot resume {}, different {}'.format(
+                        self.path, ', '.join(mismatch)))
+                self.header = old
+                self._file = open(self.path, 'a')
+                return
+        self.header = header
+        self.count = 0
+        self._measured.clear()
+        self._file = open(self.path, 'w')
+        self._write(header)
+
+    def _load(self):
+        """Read the header and the measured points of the existing file,
+        dropping a last line left incomplete by an interruption.
+        """
+        with open(self.path, 'rb+') as f:
+            content = f.read()
+            end = content.rfind(b'\n') + 1
+            if end < len(content):
+                f.truncate(end)
+        lines = content[:end].decode().splitlines()
+        if not lines:
+            return None
+        header = json.loads(lines[0])
+        for line in lines[1:]:
+            self._measured.add(tuple(json.loads(line)[:3]))
+        self.count = len(lines) - 1
+        return header
+
+    def is_measured(self, radius, xgrid, ygrid):
+        return (radius, xgrid, ygrid) in self._measured
+
+    def append(self, row):
+        self._write(list(row))
+        self._measured.add(tuple(row[:3]))
+        self.count += 1
+
+    def _write(self, obj):
+        self._file.write(json.dumps(obj) + '\n')
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_rows(path):
+    """Header and iterator over the points of a characterization file."""
+    f = open(path, 'r')
+    header = json.loads(f.readline())
+
+    def rows():
+        with f:
+            for line in f:
+                if line.endswith('\n'):
+                    yield tuple(json.loads(line))
+    return header, rows()
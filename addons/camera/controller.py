@@ -0,0 +1,160 @@
+import time
+import numpy as np
+
+
+class SpotController(object):
+    """Closed loop positioning of the spot: sets the grid deflection, finds
+    where the spot went, and corrects the deflection toward the target until
+    it is within `tolerance` or the `deadline` passes.
+
+    Corrections go through an estimate of the inverse of the spot's response
+    to the deflection, taken from the characterization lookup when there is
+    one, or measured by probing otherwise, and refined on every iteration
+    (Broyden update).
+
+    Args:
+        apply (callable): apply(valx, valy) sets the deflection and returns
+            once it settled
+        locate (callable): locate() returns the spot coordinates in a frame
+            taken after the call, or None if not found
+        lookup (Lookup): characterization lookup for the first guess and the
+            response estimate, optional
+        gain (float): fraction of the estimated correction applied each time
+        max_step (float): largest change of the deflection per iteration
+        tolerance (float): distance to the target considered reached
+        deadline (float): seconds to give up after
+        budget (float): seconds an iteration should take at most, longer
+            ones are counted as overruns
+        probe (float): deflection change used to measure the response
+        resolution (float): smallest change of the PWM values
+    """
+    def __init__(self, apply, locate, lookup=None, gain=0.7, max_step=0.2,
+                 tolerance=1.0, deadline=5.0, budget=0.5, probe=0.05,
+                 resolution=1/255):
+        self.apply = apply
+        self.locate = locate
+        self.lookup = lookup
+        self.gain = gain
+        self.max_step = max_step
+        self.tolerance = tolerance
+        self.deadline = deadline
+        self.budget = budget
+        self.probe = probe
+        self.resolution = resolution
+
+    def run(self, x, y, cancelled=None, report=None):
+        """Bring the spot to (x, y).
+
+        Args:
+            cancelled (callable): stops the loop when it returns True
+            report (callable): called with the state of every iteration
+
+        Returns:
+            dict with the `reason` it stopped ('converged', 'deadline',
+            'cancelled', 'lost' if the spot was not found, 'unresponsive' if
+            it doesn't move with the deflection, 'stalled' if the corrections
+            got below the PWM resolution, e.g. with the target out of reach),
+            the final `position`, `error` and `values` (valx, valy), the
+            `iterations`, the loop `rate` in Hz and the `timing` of the
+            iterations in ms
+        """
+        start = time.perf_counter()
+        target = np.array((x, y), dtype=float)
+        durations = []
+        if self.lookup is not None:
+            values = np.array(self.lookup.query(x, y)[0])
+        else:
+            values = np.zeros(2)
+        position = self._measure(values, durations)
+        inverse = self._inverse(values, position, durations)
+        reason = 'lost' if position is None else 'unresponsive'
+        while position is not None and inverse is not None:
+            error = target - position
+            if np.hypot(*error) <= self.tolerance:
+                reason = 'converged'
+                break
+            if time.perf_counter() - start > self.deadline:
+                reason = 'deadline'
+                break
+            if cancelled is not None and cancelled():
+                reason = 'cancelled'
+                break
+            step = self.gain * inverse @ error
+            norm = np.hypot(*step)
+            if norm > self.max_step:
+                step *= self.max_step / norm
+            step = np.clip(values + step, -1, 1) - values
+            if np.hypot(*step) < self.resolution / 2:
+                reason = 'stalled'
+                break
+            values = values + step
+            new_position = self._measure(values, durations)
+            if new_position is None:
+                position = None
+                reason = 'lost'
+                break
+            # Broyden update of the inverse response with the last step
+            moved = new_position - position
+            if moved @ moved > 0:
+                inverse += np.outer(step - inverse @ moved, moved) / \
+                    (moved @ moved)
+            position = new_position
+            if report is not None:
+                report({'iteration': len(durations), 'values': list(values),
+                        'position': list(position),
+                        'error': float(np.hypot(*(target - position))),
+                        'ms': durations[-1] * 1000})
+        elapsed = time.perf_counter() - start
+        ms = np.array(durations) * 1000
+        return {'reason': reason,
+                'position': None if position is None else list(position),
+                'error': None if position is None else
+                float(np.hypot(*(target - position))),
+                'values': list(values),
+                'iterations': len(durations),
+                'rate': len(durations) / elapsed if elapsed else 0.0,
+                'timing': {'mean': float(ms.mean()),
+                           'p50': float(np.percentile(ms, 50)),
+                           'p90': float(np.percentile(ms, 90)),
+                           'max': float(ms.max()),
+                           'overruns': int(np.sum(ms > self.budget * 1000))}}
+
+    def _measure(self, values, durations):
+        """Apply `values` and locate the spot, timing the iteration."""
+        start = time.perf_counter()
+        self.apply(*values)
+        position = self.locate()
+        durations.append(time.perf_counter() - start)
+        return None if position is None else np.array(position, dtype=float)
+
+    def _inverse(self, values, position, durations):
+        """Estimate of the deflection change per spot displacement around
+        `values`, as a 2x2 matrix. None if it can't be measured.
+        """
+        if position is None:
+            return None
+        if self.lookup is not None:
+            # finite differences of the lookup around the current position
+            h = max(self.tolerance, 1.0)
+            columns = []
+            for offset in ((h, 0), (0, h)):
+                ahead = self.lookup.query(*(position + offset))[0]
+                behind = self.lookup.query(*(position - offset))[0]
+                columns.append((np.array(ahead) - behind) / (2 * h))
+            inverse = np.column_stack(columns)
+            if np.linalg.matrix_rank(inverse) == 2:
+                return inverse
+        # response to small deflections along each axis
+        response = []
+        for axis in range(2):
+            probe = np.array(values, dtype=float)
+            probe[axis] += self.probe if probe[axis] <= 0 else -self.probe
+            moved = self._measure(probe, durations)
+            if moved is None:
+                return None
+            response.append((moved - position) / (probe[axis] - values[axis]))
+        self.apply(*values)
+        response = np.column_stack(response)
+        if np.linalg.matrix_rank(response) < 2:
+            return None
+        return np.linalg.inv(response)
@@ -1,42 +1,61 @@
 import json
-import matplotlib.pyplot as plt
 import numpy as np
-import os
-import platform
-from scipy.ndimage import label
-from skimage.io import imread
-from skimage.measure import regionprops
-from skimage.morphology import disk as mdisk
-from skimage.morphology import binary_opening
-from subprocess import call
+from addons.camera.framesource import CommandSource
+from scipy.ndimage import binary_dilation, binary_erosion, label
+
+# same as skimage.morphology.disk(1), used to open the thresholded image
+CROSS = np.array([[0, 1, 0], [1, 1, 1], [0, 1, 0]], dtype=bool)
+# bins of the threshold histogram, the threshold is searched in the upper half
+BINS = 20
+
+
+def pyplot():
+    """matplotlib.pyplot, imported on the first plot as it is slow to load,
+    with the Agg backend as the plots are only saved to files.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
 
 
 class Deviation(object):
     """The class should be used like this:
     1- Instantiate with a calibration file, which shouldn't change for the whole
         experiment
-    2- Capture the image from the camera - capture(filename, device)
+    2- Grab the image from a frame source - grab(source)
     3- Get the spot coords and optionally plot result - findspot(figpath)
     Repeat 2-3 as needed.
 
     `self.rect` is [(x1, y1), (x2, y2)] for topleft and bottomright respectively.
+
+    With `tracking`, findspot first looks for the spot in a `window` pixels
+    wide square around its last position, and searches the whole rect only when
+    it is not found there, or not unambiguously. `self.last_path` tells which
+    search, 'window' or 'full', gave the last result.
     """
-    def __init__(self, calibrationfile, addon_path=None):
-        # the plotting backend switch is usually required
+    def __init__(self, calibrationfile, addon_path=None, tracking=False,
+                 window=64):
+        self.tracking = tracking
+        self.window = window
+        self.last_path = None
+        # last spot found, as (row, col) in the rect, and its threshold
+        self._last = None
+        self._level = None
+        self.image = None
         try:
             self.load_calibration(calibrationfile)
         except FileNotFoundError:
             self.rect = None
         # needed to reference the CommandCam.exe program on Windows
         self.addon_path = addon_path
-        print('Plotting backend:', plt.get_backend())
-        print('Switching to Agg...')
-        plt.switch_backend('Agg')
-        print('Plotting backend:', plt.get_backend())
+        # reused by findspot between frames
+        self._roi = self._binary = None
 
     def load_image(self, filename):
         """Load an image file.
         """
+        from skimage.io import imread
         try:
             self.image = imread(filename)
         except FileNotFoundError:
@@ -50,11 +69,15 @@ class Deviation(object):
             self.rect = [(rect["topleft"]["x"], rect["topleft"]["y"]),
                          (rect["bottomright"]["x"], rect["bottomright"]["y"])]
             self.rect = [(int(x), int(y)) for x, y in self.rect]
+        self._last = None
 
     def findspot(self, figpath=None, spotsize=15):
         """Find the coordinates of the laser spot based on choosing a bin of the
         image histogram with an amount of bright pixels bigger than `spotsize`.
 
+        When tracking, the window around the last spot is tried first, unless
+        there is a plot to make.
+
         Args:
             figpath (str): specifies the path for the plot, or no plot if not given.
             spotsize (int): is the number of pixels considered sufficient to be a spot.
@@ -62,38 +85,48 @@ class Deviation(object):
         Returns:
             found coordinates as (coordx, coordy)
         """
-        if self.rect == None or self.image == None:
+        if self.rect is None or self.image is None:
             return None
         rect = self.rect
         # working only on the red channel
         impart = self.image[rect[0][1]:rect[1][1]+1, rect[0][0]:rect[1][0]+1, 0]
-        hvals, bins = np.histogram(impart, bins=20)
+        height, width = impart.shape
+        # forgets the last position if the ROI changed
+        roi, binary = self._buffers(impart.shape, impart.dtype)
+        if self.tracking and not figpath:
+            centroid = self._track(impart, spotsize)
+            if centroid is not None:
+                self.last_path = 'window'
+                y, x = centroid
+                return x - width/2, -y + height/2
+        self.last_path = 'full'
+        self._last = None
+        np.copyto(roi, impart)
         # adaptive threshold finding depending on the minimum spot size
-        index = 19
-        while index > 10:
-            # search for minimum number of bright pixels
-            if sum(hvals[index:]) > spotsize:
-                break
-            index -= 1
-        binary = impart >= bins[index]
-        labelim, _ = label(binary)
-        regions = regionprops(labelim)
-        if len(regions) > 1:
-            binary = binary_opening(binary, mdisk(1))
-            labelim, _ = label(binary)
-            regions = regionprops(labelim)
-            if len(regions) == 0:
+        level = self._threshold(roi, spotsize)
+        np.greater_equal(roi, level, out=binary)
+        # the rest works on the box bounding the bright pixels, with a margin
+        # of one pixel so that the opening sees the same neighbourhood
+        top, left, window = self._bounding_window(binary)
+        labelim, nregions = label(window, CROSS)
+        if nregions > 1:
+            eroded = binary_erosion(window, CROSS, border_value=1)
+            window = binary_dilation(eroded, CROSS, output=window)
+            labelim, nregions = label(window, CROSS)
+            if nregions == 0:
                 return None
+        _, centroids = self._moments(window, labelim, nregions)
+        centroids += (top, left)
         # plotting if there is a save path for the figure
         if figpath:
+            plt = pyplot()
             plt.gray()
             fig, ax = plt.subplots(1, 1, figsize=(5, 5))
-            height, width = labelim.shape
             # bound axes to the grid ref sys
             ax.set_xlim(-100, 100)
             ax.set_ylim(-100, 100)
             # all transparent black pixels
-            rgbalabelim = np.zeros((labelim.shape[0], labelim.shape[1], 4))
+            rgbalabelim = np.zeros((height, width, 4))
             # opaque on white pixels
             rgbalabelim[binary, 3] = 1
             # blue on white pixels
@@ -108,44 +141,146 @@ class Deviation(object):
             # TODO: check if its 200 or 201
             sx, sy = 200/width, 200/height
             # plot even if there is more than one region
-            for i, reg in enumerate(regions):
+            for i, (y, x) in enumerate(centroids):
                 # conversion to the coordinates of the grid - center at (0,0)
-                y, x = reg.centroid
                 x, y = x - width/2, -y + height/2
                 ax.plot(sx*x, sy*y, '+r', markersize=10, markeredgewidth=1)
                 if i >= 19:
                     break
             fig.savefig(figpath, bbox_inches='tight')
+            plt.close(fig)
         # plot anyway, but notify it didn't work
-        if len(regions) > 1:
+        if nregions != 1:
             return None
-        return x, y
+        self._last, self._level = centroids[0], level
+        # conversion to the coordinates of the grid - center at (0,0)
+        y, x = centroids[0]
+        return x - width/2, -y + height/2
 
-    def capture(self, filename, device):
-        """Capture and save a snapshot from a webcam, then load it.
+    def _track(self, impart, spotsize):
+        """Centroid of the spot searched in the window around its last
+        position, as (row, col) in `impart`, or None if it was not found
+        there as a single region away from the window borders.
+        """
+        if self._last is None:
+            return None
+        height, width = impart.shape
+        row, col = (int(round(c)) for c in self._last)
+        # e.g. a smaller frame than the one the spot was last found in
+        if not (0 <= row < height and 0 <= col < width):
+            return None
+        half = self.window // 2
+        top, left = max(row - half, 0), max(col - half, 0)
+        bottom, right = min(row + half + 1, height), min(col + half + 1, width)
+        part = impart[top:bottom, left:right]
+        # the spot left the window, or it is much dimmer than it was
+        if part.size == 0 or part.max() < self._level:
+            return None
+        level = self._threshold(part, spotsize)
+        binary = part >= level
+        # a region touching a border inside the rect may continue outside
+        if (top > 0 and binary[0].any()) or \
+                (bottom < height and binary[-1].any()) or \
+                (left > 0 and binary[:, 0].any()) or \
+                (right < width and binary[:, -1].any()):
+            return None
+        row, col, binary = self._bounding_window(binary)
+        labelim, nregions = label(binary, CROSS)
+        if nregions > 1:
+            binary = binary_dilation(binary_erosion(binary, CROSS,
+                                                    border_value=1), CROSS)
+            labelim, nregions = label(binary, CROSS)
+        if nregions != 1:
+            return None
+        _, centroids = self._moments(binary, labelim, nregions)
+        self._last = centroids[0] + (top + row, left + col)
+        return self._last
+
+    def _buffers(self, shape, dtype):
+        """Arrays for the ROI and its thresholded version, allocated again only
+        when the calibration or the camera changes, which also resets the
+        tracking.
+        """
+        if self._roi is None or self._roi.shape != shape or \
+                self._roi.dtype != dtype:
+            self._roi = np.empty(shape, dtype)
+            self._binary = np.empty(shape, bool)
+            # the last position is meaningless in another ROI
+            self._last = None
+        return self._roi, self._binary
 
-        CommandCam.exe most useful options:
-            /devname    select device by name as seen with /devlist
-            /devnum     select device by number
-            /devlist    list devices
-            /filename   captured image destination file
+    @staticmethod
+    def _bounding_window(binary):
+        """View of `binary` on the box bounding its true pixels grown by one
+        pixel, and the row and column of its top left corner.
+        """
+        height, width = binary.shape
+        indices = np.flatnonzero(binary)
+        if len(indices) == 0:
+            return 0, 0, binary[:0, :0]
+        rows, cols = np.divmod(indices, width)
+        top, left = max(rows[0] - 1, 0), max(cols.min() - 1, 0)
+        bottom, right = min(rows[-1] + 2, height), min(cols.max() + 2, width)
+        return top, left, binary[top:bottom, left:right]
+
+    @staticmethod
+    def _threshold(roi, spotsize):
+        """Left edge of the highest of the upper `BINS`/2 bins of the
+        histogram of `roi` with more than `spotsize` pixels at or above it, as
+        the bins of np.histogram(roi, bins=BINS), or the middle edge when none.
+        """
+        if roi.dtype == np.uint8:
+            counts = np.bincount(roi.ravel(), minlength=256)
+            levels = np.flatnonzero(counts)
+            low, high = float(levels[0]), float(levels[-1])
+        else:
+            low, high = float(roi.min()), float(roi.max())
+        if low == high:
+            low, high = low - 0.5, high + 0.5
+        edges = np.linspace(low, high, BINS + 1)[BINS//2:BINS]
+        if roi.dtype == np.uint8:
+            # pixels at or above each level, cumulated from the brightest
+            above = np.cumsum(counts[::-1])[::-1]
+            above = np.append(above, 0)[np.ceil(edges).astype(np.intp)]
+        else:
+            above = np.count_nonzero(roi >= edges[:, None, None], axis=(1, 2))
+        bright = np.flatnonzero(above[1:] > spotsize)
+        return edges[bright[-1] + 1] if len(bright) else edges[0]
+
+    @staticmethod
+    def _moments(binary, labelim, nregions):
+        """Area and (row, column) centroid of each labelled region, from the
+        moments of its pixels.
+        """
+        indices = np.flatnonzero(binary)
+        labels = labelim.ravel()[indices]
+        rows, cols = np.divmod(indices, binary.shape[1])
+        area = np.bincount(labels, minlength=nregions + 1)[1:]
+        rowsum = np.bincount(labels, rows, nregions + 1)[1:]
+        colsum = np.bincount(labels, cols, nregions + 1)[1:]
+        return area, np.column_stack((rowsum / area, colsum / area))
+
+    def grab(self, source):
+        """Take the next frame from a `FrameSource` as the image to process.
+        """
+        self.image = source.grab()
+
+    def save_image(self, filename):
+        """Write the current image, e.g. for the user interface.
+        """
+        from skimage.io import imsave
+        imsave(filename, self.image, check_contrast=False)
+
+    def capture(self, filename, device):
+        """Capture and save a snapshot from a webcam with an external program,
+        then load it. See `CommandSource`.
 
         Args:
             device (str): name of the capture device. Example: Linux '/dev/video0'.
             filename (str): is the destination path for the snapshot image.
                 Extension must be included and be in jpeg format.
         """
-        plat = platform.system()
-        if plat == 'Windows':
-            # the device name must be exactly the one shown with command /devlist
-            # spaces in the name are allowed
-            capture_soft_path = os.path.join(self.addon_path, 'CommandCam.exe')
-            args = '{} /devname "{}" /filename "{}"'.format(capture_soft_path, device, filename)
-        else:
-            args = 'streamer -c "{}" -o "{}"'.format(device, filename)
-        _ = call(args)
-        self.load_image(filename)
-
+        self.grab(CommandSource(device, self.addon_path, filename))
 
 if __name__ == '__main__':
     import argparse
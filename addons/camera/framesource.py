@@ -0,0 +1,237 @@
+import os
+import platform
+import tempfile
+import threading
+import time
+from subprocess import call
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+
+
+class FrameSource(object):
+    """Source of camera frames, handed out as RGB numpy arrays by `grab`.
+
+    Sources keep their device open between frames, until `close`. They can be
+    used as context managers.
+    """
+    def grab(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CommandSource(FrameSource):
+    """Frames captured by an external program for each grab, as done
+    originally: `streamer` on Linux and CommandCam.exe on Windows.
+
+    CommandCam.exe most useful options:
+        /devname    select device by name as seen with /devlist
+        /devnum     select device by number
+        /devlist    list devices
+        /filename   captured image destination file
+
+    Args:
+        device (str): name of the capture device. Example: Linux '/dev/video0'.
+            On Windows it must be exactly the one shown with /devlist, spaces
+            in the name are allowed.
+        addon_path (str): folder of CommandCam.exe
+        filename (str): path where the program writes the snapshot, in jpeg
+            format. A temporary file if not given.
+    """
+    def __init__(self, device, addon_path=None, filename=None):
+        self.device = device
+        self.addon_path = addon_path
+        self._temporary = filename is None
+        if filename is None:
+            fd, filename = tempfile.mkstemp(suffix='.jpeg')
+            os.close(fd)
+        self.filename = filename
+
+    def grab(self):
+        if platform.system() == 'Windows':
+            capture_soft_path = os.path.join(self.addon_path, 'CommandCam.exe')
+            args = [capture_soft_path, '/devname', self.device,
+                    '/filename', self.filename]
+        else:
+            args = ['streamer', '-c', self.device, '-o', self.filename]
+        _ = call(args)
+        from skimage.io import imread
+        return imread(self.filename)
+
+    def close(self):
+        if self._temporary and os.path.exists(self.filename):
+            os.remove(self.filename)
+
+
+class OpenCVSource(FrameSource):
+    """Frames read from a device kept open with OpenCV, which must be
+    installed.
+
+    Cameras queue a few frames, so `flush` frames are dropped before each grab
+    to return one taken after the call, e.g. after the voltages settled.
+
+    Args:
+        device (str or int): device path such as '/dev/video0', or its index
+        flush (int): queued frames dropped before each grab
+    """
+    def __init__(self, device, flush=2):
+        import cv2
+        self._cv2 = cv2
+        if isinstance(device, str) and device.isdigit():
+            device = int(device)
+        self.device = device
+        self.flush = flush
+        self._capture = cv2.VideoCapture(device)
+        if not self._capture.isOpened():
+            self._capture.release()
+            raise IOError('Cannot open the camera {}'.format(device))
+        self._capture.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+
+    def grab(self):
+        for _ in range(self.flush):
+            self._capture.grab()
+        ok, frame = self._capture.read()
+        if not ok:
+            raise IOError('Cannot read from the camera {}'.format(self.device))
+        return self._cv2.cvtColor(frame, self._cv2.COLOR_BGR2RGB)
+
+    def close(self):
+        self._capture.release()
+
+
+class ReplaySource(FrameSource):
+    """Frames read from an image file, or from the images of a folder in name
+    order, to work without a camera. Images are decoded once, and replayed in
+    a loop.
+
+    Args:
+        path (str): image file or folder
+    """
+    def __init__(self, path):
+        if os.path.isdir(path):
+            names = sorted(name for name in os.listdir(path)
+                           if name.lower().endswith(IMAGE_EXTENSIONS))
+            paths = [os.path.join(path, name) for name in names]
+        elif os.path.isfile(path):
+            paths = [path]
+        else:
+            paths = []
+        if not paths:
+            raise IOError('No images in {}'.format(path))
+        self.paths = paths
+        self._frames = [None] * len(paths)
+        self._index = 0
+
+    def grab(self):
+        index = self._index
+        self._index = (index + 1) % len(self.paths)
+        if self._frames[index] is None:
+            from skimage.io import imread
+            self._frames[index] = imread(self.paths[index])
+        return self._frames[index]
+
+
+class FrameGrabber(object):
+    """Grabs frames from a source continuously on a thread, keeping only the
+    latest one so that consumers slower than the camera never work on stale
+    frames.
+
+    Frames are stamped with the time their grab started, so that `latest`
+    can wait for one taken after a given moment, e.g. after the voltages
+    settled.
+
+    Args:
+        source (FrameSource): source owned by the grabber until stopped
+        max_rate (float): frames per second at most, to not spin on sources
+            that return immediately such as ReplaySource
+    """
+    def __init__(self, source, max_rate=30):
+        self.source = source
+        self.max_rate = max_rate
+        self.error = None
+        # latest frame, its grab start time and sequence number
+        self._frame = None
+        self._time = None
+        self._count = 0
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='camera-grabber')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        period = 1 / self.max_rate if self.max_rate else 0
+        while not self._stop.is_set():
+            start = time.time()
+            try:
+                frame = self.source.grab()
+            except Exception as e:
+                with self._cond:
+                    self.error = e
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                self._frame, self._time = frame, start
+                self._count += 1
+                self._cond.notify_all()
+            self._stop.wait(period - (time.time() - start))
+
+    def latest(self, after=None, since=None, timeout=2.0):
+        """Latest frame as (count, time, frame), once there is one with a
+        sequence number greater than `after` and taken at or after time
+        `since`, whichever are given.
+
+        Raises:
+            IOError: if the source failed, or no such frame came in `timeout`
+        """
+        def ready():
+            if self.error is not None or self._frame is None:
+                return self.error is not None
+            return (after is None or self._count > after) and \
+                (since is None or self._time >= since)
+
+        with self._cond:
+            if not self._cond.wait_for(ready, timeout):
+                raise IOError('No new frame from the camera')
+            if self.error is not None:
+                raise IOError('Camera error: {}'.format(self.error))
+            return self._count, self._time, self._frame
+
+
+def open_source(device, addon_path=None):
+    """Frame source for `device`, which can be prefixed to choose the backend:
+
+        'replay:<path>'     ReplaySource of an image file or folder
+        'command:<device>'  CommandSource, the external capture program
+        '<device>'          OpenCVSource, or CommandSource if OpenCV is not
+                            installed or cannot open the device
+    """
+    if device.startswith('replay:'):
+        return ReplaySource(device[len('replay:'):])
+    if device.startswith('command:'):
+        return CommandSource(device[len('command:'):], addon_path)
+    try:
+        return OpenCVSource(device)
+    except (ImportError, IOError):
+        return CommandSource(device, addon_path)
@@ -0,0 +1,100 @@
+import os
+import threading
+import numpy as np
+from addons.camera.characterization import read_rows
+from scipy.spatial import cKDTree
+
+
+def pin_values(valx, valy):
+    """PWM values for the pins (right top left bottom) that deflect the beam
+    by (valx, valy) in the grid, as characterized.
+    """
+    values = [0.0, 0.0, 0.0, 0.0]
+    i = 0 if valx > 0 else 2
+    j = 1 if valy > 0 else 3
+    values[i] = abs(valx)
+    values[j] = abs(valy)
+    return values
+
+
+class Lookup(object):
+    """Inverse of a characterization: the grid deflection that puts the spot
+    at given coordinates, from an affine fit of the `neighbours` nearest
+    measured points, or their inverse distance weighting where they are
+    aligned.
+
+    The index is built from the characterization file on first use, and
+    rebuilt whenever the file changes.
+    """
+    def __init__(self, path, neighbours=6):
+        self.path = path
+        self.neighbours = neighbours
+        self.pins = None
+        self._stamp = None
+        self._tree = None
+        self._grid = None
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        stat = os.stat(self.path)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp == self._stamp:
+            return
+        with self._lock:
+            if stamp == self._stamp:
+                return
+            header, rows = read_rows(self.path)
+            points, grid = [], []
+            for _, valx, valy, x, y, _ in rows:
+                if x is not None:
+                    points.append((x, y))
+                    grid.append((valx, valy))
+            if not points:
+                raise ValueError('No spot found in {}'.format(self.path))
+            self.pins = header['params']['pins']
+            self._grid = np.array(grid)
+            self._tree = cKDTree(points)
+            self._stamp = stamp
+
+    def query(self, x, y):
+        """Grid deflection (valx, valy) for the spot to be at (x, y), and the
+        distance from (x, y) to the nearest measured spot, which tells how
+        much the result is extrapolated.
+        """
+        self._refresh()
+        tree, grid = self._tree, self._grid
+        k = min(self.neighbours, tree.n)
+        distances, indices = tree.query((x, y), k=k)
+        distances, indices = np.atleast_1d(distances), np.atleast_1d(indices)
+        if distances[0] == 0:
+            valx, valy = grid[indices[0]]
+        else:
+            points = np.column_stack((tree.data[indices], np.ones(k)))
+            fit, _, rank, _ = np.linalg.lstsq(points, grid[indices],
+                                              rcond=None)
+            if rank == 3:
+                valx, valy = np.array((x, y, 1.0)) @ fit
+            else:
+                weights = 1 / distances**2
+                valx, valy = weights @ grid[indices] / weights.sum()
+        return (float(valx), float(valy)), float(distances[0])
+
+    def values(self, x, y):
+        """Pins and their PWM values for the spot to be at (x, y), and the
+        distance to the nearest measured spot. See `query`. Values beyond the
+        range of the pins are clipped.
+        """
+        (valx, valy), distance = self.query(x, y)
+        values = [min(value, 1.0) for value in pin_values(valx, valy)]
+        return self.pins, values, distance
+
+
+_lookups = {}
+
+
+def get_lookup(path='characterization.jsonl'):
+    """Lookup of the characterization file `path`, shared by all callers."""
+    path = os.path.abspath(path)
+    if path not in _lookups:
+        _lookups[path] = Lookup(path)
+    return _lookups[path]
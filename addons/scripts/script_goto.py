@@ -0,0 +1,36 @@
+import time
+from addons.camera.lookup import get_lookup
+from modules.app_script import Script
+
+
+class AppScript(Script):
+    def __init__(self, cherry):
+        Script.__init__(self, cherry)
+
+    def run(self, points, settling=0, path='characterization.jsonl'):
+        """Steers the spot through the given points, with the PWM values
+        interpolated from a characterization of the camera addon.
+
+        Args:
+            points (list of float pairs): grid coordinates. Example: ((0, 0), (10, -5))
+            settling (int): milis to wait at each point
+            path (str): characterization file
+
+        Returns:
+            [point1:[values, distance], ...] the values set on the pins
+            (right top left bottom) for each point, and the distance to the
+            nearest measured spot
+        """
+        lookup = get_lookup(path)
+        results = []
+        for x, y in points:
+            if self.cancelled():
+                break
+            pins, values, distance = lookup.values(x, y)
+            res = self.serial_write('vset', [pins, values])
+            if not res['success']:
+                raise RuntimeError(res['info'])
+            time.sleep(settling / 1000)
+            results.append([values, distance])
+            self.report(len(results) / len(points), results[-1])
+        return results
@@ -1,5 +1,7 @@
 from modules.app_script import Script
-import time
+
+# steps sent to the board at once, between progress reports
+BLOCK = 100
 
 
 class AppScript(Script):
@@ -8,7 +10,8 @@ class AppScript(Script):
         self.data = []
 
     def run(self, out_pins, in_pins, out_values, settling):
-        """Performs a sweep of voltages.
+        """Performs a sweep of voltages. Steps are timed by the board and sent
+        in blocks, so that progress and cancellation are checked in between.
 
         Args:
             out_pins (int list): example: (3,9)
@@ -20,14 +23,15 @@ class AppScript(Script):
             [step1:[p1 p2 ...], step2:[p1 p2 ...], ...] In other words, a list of steps, where each step is a list of the values on each pin
         """
         results = []
-        # iterate over the values, zipping them for convenience
-        for vals in zip(out_values):
-            # write the values to the board one pin at a time
-            res = self.serial_write('vset', (out_pins, vals))
-            # wait for settling time after all pins are written
-            time.sleep(settling/1000)
-            # collect the readings of the current step
-            step = self.serial_write('vread', (in_pins,))
-            # append the steps together
-            results.append(step)
+        total = len(out_values[0]) if out_values else 0
+        for start in range(0, total, BLOCK):
+            if self.cancelled():
+                break
+            block = [values[start:start+BLOCK] for values in out_values]
+            res = self.serial_write('sweep',
+                                    [out_pins, in_pins, block, settling])
+            if not res['success']:
+                raise RuntimeError(res['info'])
+            results.extend(res['data'])
+            self.report(len(results) / total, *res['data'])
         return results
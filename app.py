@@ -2,8 +2,14 @@ import argparse
 import cherrypy
 import importlib
 import json
+import threading
+from modules.lazy_addon import LazyAddon, read_addon_metadata
+from modules.plugin_jobs import JobPlugin
+from modules.plugin_push import PushPlugin
 from modules.plugin_serialobject import SerialObjectPlugin
+from modules.script_registry import ScriptRegistry
 from modules.makotool import TemplateTool
+from modules.metrics import registry
 import os
 import platform
 
@@ -33,11 +39,13 @@ cherrypy.tools.render = TemplateTool(path)
 class Controller(object):
 
     # def __init__(self, quickstart=False, verbose=False):
-    def __init__(self, quickstart=False):
+    def __init__(self, quickstart=False, warmup=False):
         # Search for addons as folders inside the addons folder, and take the
         # first non '__init__.py' file. Builds a list of addons' info and mounts
-        # them into the server tree
+        # them into the server tree. Addons declaring their `ADDON_CONF` are
+        # mounted behind a proxy and only imported when first used
         addons = []
+        lazy = []
         for parent in os.listdir('addons/'):
             for file in os.listdir(os.path.join('addons/', parent)):
                 # only one file allowed for each addon currently
@@ -46,23 +54,48 @@ class Controller(object):
                 isaddon = isaddon and file.find('.py') != -1
                 if isnotinit and isaddon:
                     name, _ = file.split('.')
-                    module = importlib.import_module('.'.join(['addons',
-                                                              parent,
-                                                              name]))
-                    addon = module.AppAddon()
-                    cherrypy.tree.mount(addon,
-                                        addon.addon_conf['url'],
-                                        addon.cpconf)
-                    addons.append(addon.addon_conf)
+                    module_name = '.'.join(['addons', parent, name])
+                    metadata = read_addon_metadata(
+                        os.path.join('addons/', parent, file))
+                    if metadata is None:
+                        module = importlib.import_module(module_name)
+                        addon = module.AppAddon()
+                        addon_conf, cpconf = addon.addon_conf, addon.cpconf
+                    else:
+                        addon_conf, handlers = metadata
+                        addon = LazyAddon(module_name, addon_conf, handlers)
+                        cpconf = addon.cpconf(os.path.join('addons', parent))
+                        lazy.append(addon)
+                    cherrypy.tree.mount(addon, addon_conf['url'], cpconf)
+                    addons.append(addon_conf)
                     break
         self.addons = addons
 
         # Subscribe to the start channel to connect and disable verbosity when
-        # the server is ready
+        # the server is ready. Connecting takes several seconds, as pyfirmata
+        # waits for the board to reset, so it runs in the background not to
+        # delay serving
         if quickstart:
             cherrypy.engine.subscribe(
                 'start',
-                lambda: cherrypy.engine.publish('serial-connect')[0])
+                lambda: self._background(
+                    lambda: cherrypy.engine.publish('serial-connect'),
+                    'quickstart-connect'),
+                priority=80)
+        # Scripts are imported once, in the background once serving, and
+        # reloaded when their file changes
+        self.script_registry = ScriptRegistry()
+        cherrypy.engine.subscribe(
+            'start',
+            lambda: self._background(self._preload_scripts, 'script-preload'),
+            priority=80)
+        # Import the lazy addons in the background once serving
+        if warmup and lazy:
+            cherrypy.engine.subscribe(
+                'start',
+                lambda: self._background(
+                    lambda: [addon.load() for addon in lazy], 'addon-warmup'),
+                priority=80)
         # if not verbose:
         #     cherrypy.engine.subscribe(
         #         'serial-just-connected',
@@ -74,6 +107,16 @@ class Controller(object):
     def index(self):
         return {'addons': self.addons}
 
+    @staticmethod
+    def _background(fun, name):
+        thread = threading.Thread(target=fun, name=name)
+        thread.daemon = True
+        thread.start()
+
+    def _preload_scripts(self):
+        for name, error in self.script_registry.preload().items():
+            cherrypy.engine.log('ERROR loading script {}: {}'.format(name, error))
+
     @cherrypy.expose
     @cherrypy.tools.json_out()
     def isConnected(self):
@@ -112,13 +155,12 @@ class Controller(object):
     @cherrypy.tools.json_in()
     @cherrypy.tools.json_out()
     def serialVSet(self):
-        # pins and values are lists
+        # pins and values are lists. Calls are coalesced, and the values
+        # actually written for the pins are returned as data
         json = cherrypy.request.json
         pins = json['pins']
         values = json['values']
-        return cherrypy.engine.publish(
-                    'serial-write',
-                    ['vset', pins, values])[0]
+        return cherrypy.engine.publish('serial-vset', pins, values)[0]
 
     @cherrypy.expose
     @cherrypy.tools.is_connected()
@@ -126,7 +168,36 @@ class Controller(object):
     @cherrypy.tools.json_out()
     def serialVRead(self):
         pins = cherrypy.request.json['pins']
-        return cherrypy.engine.publish('serial-write', ['vread', pins])[0]
+        samples = cherrypy.request.json.get('samples', 1)
+        return cherrypy.engine.publish('serial-write',
+                                       ['vread', pins, samples])[0]
+
+    @cherrypy.expose
+    @cherrypy.tools.is_connected()
+    @cherrypy.tools.json_in()
+    @cherrypy.tools.json_out()
+    def serialBatch(self):
+        """
+        Takes json input {"commands": [[cmd, *params], ...], "stop_on_error"}
+        where commands are in the format of `serial-write`, plus
+        ["wait", milis]. They run back to back, without other commands in
+        between.
+        Returns the result of each command run as data. With stop_on_error,
+        the default, the commands after a failed one don't run
+        """
+        commands = cherrypy.request.json['commands']
+        stop_on_error = cherrypy.request.json.get('stop_on_error', True)
+        results = cherrypy.engine.publish('serial-batch', commands,
+                                          stop_on_error)[0]
+        failed = [i for i, result in enumerate(results)
+                  if not result['success']]
+        if failed:
+            info = 'Command {} failed: {}'.format(
+                failed[0], results[failed[0]]['info'])
+        else:
+            info = None
+        return {'success': not failed and len(results) == len(commands),
+                'info': info, 'data': results}
 
     @cherrypy.expose
     @cherrypy.tools.is_connected()
@@ -144,30 +215,102 @@ class Controller(object):
         """
         Takes json input {"fname":script_name,**kwargs}
         Returns [success:bool, msg:str]
+
+        The script runs as a background job, whose id is returned as data.
+        Its progress and result are available through `jobStatus`.
         """
         fname = cherrypy.request.json['fname']
         kwargs = {k: v for k, v in cherrypy.request.json.items()
                   if k != 'fname'}
         try:
-            module = importlib.import_module('addons.scripts.'+fname)
-            script = module.AppScript(cherrypy)
-        except (ImportError, AttributeError) as exc:
+            script = self.script_registry.create(fname, cherrypy, kwargs)
+        except LookupError as exc:
+            result = {'success': False, 'info': str(exc)}
+        except TypeError as exc:
+            msg = 'Invalid arguments for script {}: {}'.format(fname, exc)
+            result = {'success': False, 'info': msg}
+        except Exception as exc:
             cherrypy.engine.log('ERROR '+str(exc))
             msg = 'Error importing the script'
             result = {'success': False, 'info': msg}
         else:
-            try:
-                # Should not return anything for now
-                data = script.run(**kwargs)
-            except Exception as exc:
-                cherrypy.engine.log('ERROR '+str(exc))
-                msg = 'Error running the script'
-                result = {'success': False, 'info': msg}
-            else:
-                msg = 'Script {} run successfully'.format(fname)
-                result = {'success': True, 'info': msg, 'data': data}
+            job_id = cherrypy.engine.publish(
+                'job-submit', fname, self._run_script, script, kwargs)[0]
+            msg = 'Script {} started'.format(fname)
+            result = {'success': True, 'info': msg, 'data': {'job': job_id}}
         return result
 
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def scripts(self):
+        """
+        Returns the available scripts, with the signature and docstring of
+        their `run`, or the error loading them.
+        """
+        return {'success': True, 'info': None,
+                'data': self.script_registry.describe()}
+
+    @staticmethod
+    def _run_script(job, script, kwargs):
+        script.job = job
+        return script.run(**kwargs)
+
+    @cherrypy.expose
+    def events(self):
+        """
+        Server-sent events stream of the connection state, the analog
+        readings and the job updates, see `PushPlugin`. Each event's data is
+        json.
+        """
+        cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        client = cherrypy.engine.publish('push-subscribe')[0]
+
+        def stream():
+            try:
+                yield b'retry: 2000\n\n'
+                while True:
+                    events = client.get(timeout=15)
+                    if events is None:
+                        break
+                    if not events:
+                        # keeps proxies from closing an idle stream, and
+                        # detects gone clients
+                        yield b': keepalive\n\n'
+                    for event, data in events:
+                        yield 'event: {}\ndata: {}\n\n'.format(
+                            event, json.dumps(data)).encode('utf-8')
+            finally:
+                cherrypy.engine.publish('push-unsubscribe', client)
+        return stream()
+    events._cp_config = {'response.stream': True}
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def jobs(self):
+        return {'success': True, 'info': None,
+                'data': cherrypy.engine.publish('job-list')[0]}
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def jobStatus(self, job, since=0):
+        """
+        Returns the state, progress, result and the partial results produced
+        from index `since` of the given job.
+        """
+        status = cherrypy.engine.publish('job-status', int(job), int(since))[0]
+        if status is None:
+            return {'success': False, 'info': 'Unknown job', 'data': None}
+        return {'success': status['state'] != 'failed', 'info': status['info'],
+                'data': status}
+
+    @cherrypy.expose
+    @cherrypy.tools.json_out()
+    def jobCancel(self, job):
+        if not cherrypy.engine.publish('job-cancel', int(job))[0]:
+            return {'success': False, 'info': 'Unknown job', 'data': None}
+        return {'success': True, 'info': 'Cancel requested', 'data': None}
+
     @cherrypy.expose
     @cherrypy.tools.is_connected()
     @cherrypy.tools.json_out()
@@ -176,6 +319,15 @@ class Controller(object):
         _ = cherrypy.engine.publish('serial-hiz-mode', hiz)
         return {'success': True, 'info': None, 'data': None}
 
+    @cherrypy.expose
+    def metrics(self):
+        """
+        Command counts and latencies, bytes on the wire and timeouts, in the
+        Prometheus text format.
+        """
+        cherrypy.response.headers['Content-Type'] = 'text/plain; version=0.0.4'
+        return registry.render()
+
     def __del__(self):
         _ = self.disconnect()
 
@@ -208,6 +360,18 @@ if __name__ == '__main__':
     parser.add_argument(
         "-p", "--port", type=int, action="store", default=8081,
         help="port number for the web server")
+    parser.add_argument(
+        "-w", "--warmup", action="store_true", default=False,
+        help="import the addons in the background after starting, instead of on their first use")
+    parser.add_argument(
+        "-r", "--readings-rate", type=float, action="store", default=2.0,
+        help="analog readings per second pushed to the web interface, 0 to disable them")
+    parser.add_argument(
+        "--vset-rate", type=float, action="store", default=50.0,
+        help="writes per second at most of the values set from the web interface, newer values replace the waiting ones. 0 writes every request")
+    parser.add_argument(
+        "-e", "--emulate", action="store_true", default=False,
+        help="connect to an emulated board instead of the serial port")
     # parser.add_argument(
     #     "-v", "--verbose", action="store_true", default=False,
     #     help="verbose communication. Only works when the --connect flag is given. \
@@ -217,12 +381,23 @@ if __name__ == '__main__':
     # IP 0.0.0.0 accepts all incoming LAN ip's on the given port
     cherrypy.config.update(
         {'server.socket_host': os.getenv('IP', '0.0.0.0'),
-         'server.socket_port': int(os.getenv('PORT', args.port)), })
+         'server.socket_port': int(os.getenv('PORT', args.port)),
+         # every browser listening to /events holds a thread
+         'server.thread_pool': 30, })
+
+    if args.emulate:
+        from modules.emulator import EmulatedBoard
+        emulated_board = EmulatedBoard()
+        args.serialport = emulated_board.start()
+        cherrypy.engine.subscribe('exit', emulated_board.stop)
 
     # Serialobject plugin and main app init
-    SerialObjectPlugin(args.serialport, cherrypy.engine).subscribe()
+    SerialObjectPlugin(args.serialport, cherrypy.engine,
+                       vset_rate=args.vset_rate).subscribe()
+    JobPlugin(cherrypy.engine).subscribe()
+    PushPlugin(cherrypy.engine, rate=args.readings_rate).subscribe()
     # webapp = Controller(quickstart=args.connect, verbose=args.verbose)
-    webapp = Controller(quickstart=args.connect)
+    webapp = Controller(quickstart=args.connect, warmup=args.warmup)
 
     # Delete parser object
     args = None
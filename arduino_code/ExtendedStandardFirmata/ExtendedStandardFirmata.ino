@@ -50,6 +50,16 @@
 // Start of modification
 #define REPORT_ANALOG_NOW_QUERY 0x01  // SysEx command to request a Firmata.analogSend() of analog readings
 #define REPORT_ANALOG_NOW_RESPONSE 0x02  // SysEx command to request a Firmata.analogSend() of analog readings
+#define SWEEP_CONFIG 0x03  // SysEx command to start a sweep: settling, number of steps, input pins and output pins
+#define SWEEP_DATA 0x04  // SysEx command carrying output values to append to the sweep table
+#define SWEEP_STOP 0x05  // SysEx command to abort a running sweep
+#define SWEEP_RESULT 0x06  // SysEx command reporting the analog readings of a sweep step
+#define SWEEP_BUFFER_SIZE 128  // output values that can be stored ahead of the running step
+#define SWEEP_MAX_OUTPUTS 8
+#define PULSE_TRAIN 0x07  // SysEx command to start a train of switch pulses timed by the board
+#define PULSE_STOP 0x08  // SysEx command to abort a running pulse train
+#define PULSE_DONE 0x09  // SysEx command reporting the end of a pulse train and the pulses done
+#define PULSE_SPIN_MICROS 2000  // closer than this to a pulse edge, wait for it without leaving loop()
 // End of modification
 // ----------------------------------------------
 
@@ -90,6 +100,35 @@ signed char queryIndex = -1;
 unsigned int i2cReadDelayTime = 0;  // default delay time between i2c read request and Wire.requestFrom()
 
 Servo servos[MAX_SERVOS];
+
+// ----------------------------------------------
+// Start of modification
+/* sweep table and state */
+byte sweepTable[SWEEP_BUFFER_SIZE];  // ring buffer of output values, one per output pin and step
+byte sweepHead = 0;                  // index of the next value to apply
+byte sweepCount = 0;                 // values stored in the table
+byte sweepOutputs[SWEEP_MAX_OUTPUTS];
+byte sweepNumOutputs = 0;
+byte sweepInputs = 0;                // bitwise array of the analog pins to read on each step
+unsigned int sweepSettling = 0;      // ms between writing the outputs and reading the inputs
+unsigned int sweepSteps = 0;
+unsigned int sweepStep = 0;          // index of the running step
+unsigned long sweepStepMillis;       // time at which the outputs of the running step were written
+boolean sweepRunning = false;
+boolean sweepSettlingNow = false;
+
+/* pulse train state */
+byte pulsePins[4];                   // switch control pins (a,b,c,d)
+byte pulseMode;                      // 0: state 'a', 1: state 'b', 2: alternate 'a' and 'b'
+unsigned long pulseWidth;            // us
+unsigned long pulseGap;              // us between the end of a pulse and the start of the next one
+unsigned int pulseCount;             // pulses to do, 0 runs until stopped
+unsigned int pulsesDone;
+unsigned long pulseEdgeMicros;       // time of the next edge
+boolean pulseRunning = false;
+boolean pulseHigh = false;           // whether a pulse is being output
+// End of modification
+// ----------------------------------------------
 /*==============================================================================
  * FUNCTIONS
  *============================================================================*/
@@ -328,6 +367,99 @@ void reportDigitalCallback(byte port, int value)
   // pins configured as analog
 }
 
+// ----------------------------------------------
+// Start of modification
+/* advance the sweep state machine, called from the main loop. The outputs of a
+ * step are written as soon as its values are in the table, and the inputs are
+ * read and reported once the settling time has elapsed, so the timing does not
+ * depend on the host at all */
+void runSweep()
+{
+  int value;
+
+  if (!sweepSettlingNow) {
+    if (sweepCount < sweepNumOutputs) return;  // waiting for the host to send more values
+    for (byte i = 0; i < sweepNumOutputs; i++) {
+      byte pin = sweepOutputs[i];
+      value = sweepTable[sweepHead];
+      sweepHead = (sweepHead + 1) % SWEEP_BUFFER_SIZE;
+      sweepCount--;
+      if (IS_PIN_PWM(pin) && pinConfig[pin] == PWM) {
+        analogWrite(PIN_TO_PWM(pin), value);
+        pinState[pin] = value;
+      }
+    }
+    sweepStepMillis = millis();
+    sweepSettlingNow = true;
+  } else if (millis() - sweepStepMillis >= sweepSettling) {
+    Firmata.write(START_SYSEX);
+    Firmata.write(SWEEP_RESULT);
+    Firmata.write((byte)sweepStep & 0x7F);
+    Firmata.write((byte)(sweepStep >> 7) & 0x7F);
+    for (byte pin = 0; pin < 7; pin++) {
+      if (sweepInputs & (1 << pin)) {
+        value = analogRead(pin);
+        Firmata.write((byte)value & 0x7F);
+        Firmata.write((byte)(value >> 7) & 0x7F);
+      }
+    }
+    Firmata.write(END_SYSEX);
+    sweepSettlingNow = false;
+    sweepStep++;
+    if (sweepStep >= sweepSteps) {
+      sweepRunning = false;
+    }
+  }
+}
+/* write the switch control pins (a,b,c,d) from the 4 lower bits of `pattern` */
+void writePulsePins(byte pattern)
+{
+  for (byte i = 0; i < 4; i++) {
+    byte value = (pattern >> i) & 1;
+    digitalWrite(PIN_TO_DIGITAL(pulsePins[i]), value);
+    pinState[pulsePins[i]] = value;
+  }
+}
+
+void endPulses()
+{
+  writePulsePins(0);  // back to HI-Z
+  pulseRunning = false;
+  pulseHigh = false;
+  Firmata.write(START_SYSEX);
+  Firmata.write(PULSE_DONE);
+  Firmata.write((byte)pulsesDone & 0x7F);
+  Firmata.write((byte)(pulsesDone >> 7) & 0x7F);
+  Firmata.write(END_SYSEX);
+}
+
+/* advance the pulse train, called from the main loop. When an edge is close,
+ * it is waited for here instead of in the next iterations of the loop, so the
+ * pulse widths do not depend on how long the rest of the loop takes */
+void runPulses()
+{
+  long remaining = (long)(pulseEdgeMicros - micros());
+  if (remaining > PULSE_SPIN_MICROS) return;
+  while ((long)(pulseEdgeMicros - micros()) > 0);
+  if (!pulseHigh) {
+    byte state = pulseMode == 2 ? (pulsesDone & 1) : pulseMode;
+    // patterns (a,b,c,d) for states 'a' (1,0,0,1) and 'b' (0,1,1,0)
+    writePulsePins(state == 0 ? B1001 : B0110);
+    pulseHigh = true;
+    pulseEdgeMicros += pulseWidth;
+  } else {
+    writePulsePins(0);
+    pulseHigh = false;
+    pulsesDone++;
+    pulseEdgeMicros += pulseGap;
+    if (pulseCount > 0 && pulsesDone >= pulseCount) {
+      endPulses();
+    }
+  }
+}
+// End of modification
+// ----------------------------------------------
+
 /*==============================================================================
  * SYSEX-BASED commands
  *============================================================================*/
@@ -522,22 +654,104 @@ void sysexCallback(byte command, byte argc, byte *argv)
     // Start of modification
     // This case statement forces an analog send of the pins requested in argv[0], which are
     // encoded as a bitwise array. E.g. 0000101 would get the first and third analog pin values sent
-    case REPORT_ANALOG_NOW_QUERY:
+    // argv[1] is an optional 7-bit tag chosen by the host, which is echoed back as the first byte
+    // of the response so that several queries can be in flight at the same time
+    // argv[2] is an optional number of samples to take of each pin, echoed back as the second byte.
+    // With a single sample, each pin is followed by its value (2 bytes). With more, each pin is
+    // followed by the sum (3 bytes), the minimum and the maximum (2 bytes each) of the samples
+    case REPORT_ANALOG_NOW_QUERY: {
       byte pins = argv[0];
+      byte tag = argc > 1 ? argv[1] : 0;
+      byte samples = argc > 2 && argv[2] > 1 ? argv[2] : 1;
       int value;
       Firmata.write(START_SYSEX);
       Firmata.write(REPORT_ANALOG_NOW_RESPONSE);
+      Firmata.write(tag & 0x7F);
+      Firmata.write(samples);
       for (byte pin = 0; pin < 7; pin++) {
         if (pins & (1 << pin)) {
           //Firmata.sendAnalog(pin, analogRead(pin));
           Firmata.write(pin);
-          value = analogRead(pin);
-          Firmata.write((byte)value & 0x7F);
-          Firmata.write((byte)(value >> 7) & 0x7F);
+          if (samples == 1) {
+            value = analogRead(pin);
+            Firmata.write((byte)value & 0x7F);
+            Firmata.write((byte)(value >> 7) & 0x7F);
+          } else {
+            unsigned long sum = 0;
+            int minValue = 1023;
+            int maxValue = 0;
+            for (byte i = 0; i < samples; i++) {
+              value = analogRead(pin);
+              sum += value;
+              if (value < minValue) minValue = value;
+              if (value > maxValue) maxValue = value;
+            }
+            Firmata.write((byte)sum & 0x7F);
+            Firmata.write((byte)(sum >> 7) & 0x7F);
+            Firmata.write((byte)(sum >> 14) & 0x7F);
+            Firmata.write((byte)minValue & 0x7F);
+            Firmata.write((byte)(minValue >> 7) & 0x7F);
+            Firmata.write((byte)maxValue & 0x7F);
+            Firmata.write((byte)(maxValue >> 7) & 0x7F);
+          }
         }
       }
       Firmata.write(END_SYSEX);
       break;
+    }
+    // Sweep table upload. The sweep starts with SWEEP_CONFIG, whose arguments are the settling
+    // time in ms (2 bytes), the number of steps (2 bytes), the bitwise array of analog pins to
+    // read on each step, and the output pins. The output values are then streamed with
+    // SWEEP_DATA, two bytes per value, in step order and in the same order as the output pins.
+    // The host must not send more values than fit in the table ahead of the reported steps
+    case SWEEP_CONFIG:
+      if (argc > 5) {
+        sweepSettling = argv[0] + (argv[1] << 7);
+        sweepSteps = argv[2] + (argv[3] << 7);
+        sweepInputs = argv[4];
+        sweepNumOutputs = 0;
+        for (byte i = 5; i < argc && sweepNumOutputs < SWEEP_MAX_OUTPUTS; i++) {
+          sweepOutputs[sweepNumOutputs++] = argv[i];
+        }
+        sweepHead = 0;
+        sweepCount = 0;
+        sweepStep = 0;
+        sweepSettlingNow = false;
+        sweepRunning = sweepSteps > 0;
+      }
+      break;
+    case SWEEP_DATA:
+      for (byte i = 0; i + 1 < argc && sweepCount < SWEEP_BUFFER_SIZE; i += 2) {
+        sweepTable[(sweepHead + sweepCount) % SWEEP_BUFFER_SIZE] = argv[i] + (argv[i + 1] << 7);
+        sweepCount++;
+      }
+      break;
+    case SWEEP_STOP:
+      sweepRunning = false;
+      break;
+    // Pulse train on the switch control pins. Arguments are the four switch pins (a,b,c,d), the
+    // mode (0: 'a', 1: 'b', 2: alternate 'a' and 'b'), the pulse width and the gap between pulses
+    // in us (3 bytes each), and the number of pulses (2 bytes, 0 runs until PULSE_STOP)
+    case PULSE_TRAIN:
+      if (argc > 12) {
+        for (byte i = 0; i < 4; i++) {
+          pulsePins[i] = argv[i];
+        }
+        pulseMode = argv[4];
+        pulseWidth = argv[5] + ((unsigned long)argv[6] << 7) + ((unsigned long)argv[7] << 14);
+        pulseGap = argv[8] + ((unsigned long)argv[9] << 7) + ((unsigned long)argv[10] << 14);
+        pulseCount = argv[11] + (argv[12] << 7);
+        pulsesDone = 0;
+        pulseHigh = false;
+        pulseEdgeMicros = micros();
+        pulseRunning = true;
+      }
+      break;
+    case PULSE_STOP:
+      if (pulseRunning) {
+        endPulses();
+      }
+      break;
     // End of modification
     // ---------------------------------------------------------
   }
@@ -599,6 +813,8 @@ void systemResetCallback()
   }
   // by default, do not report any analog inputs
   analogInputsToReport = 0;
+  sweepRunning = false;
+  pulseRunning = false;
 
   /* send digital inputs to set the initial state on the host computer,
    * since once in the loop(), this firmware will only send on change */
@@ -643,6 +859,17 @@ void loop()
   while (Firmata.available())
     Firmata.processInput();
 
+  // ----------------------------------------------
+  // Start of modification
+  if (sweepRunning) {
+    runSweep();
+  }
+  if (pulseRunning) {
+    runPulses();
+  }
+  // End of modification
+  // ----------------------------------------------
+
   /* SEND FTDI WRITE BUFFER - make sure that the FTDI buffer doesn't go over
    * 60 bytes. use a timer to sending an event character every 4 ms to
    * trigger the buffer to dump. */
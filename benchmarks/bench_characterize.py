@@ -0,0 +1,61 @@
+import itertools
+import os
+import tempfile
+
+import cherrypy
+
+from addons.camera.addon_camera import AppAddon
+from benchmarks.bench_findspot import centered_rect, load_corpus
+from benchmarks.common import summarize, timeit
+
+
+class StubJob(object):
+    """Stand-in for the `Job` handle given by `JobPlugin`."""
+    def report(self, progress=None, *partial):
+        pass
+
+    def cancelled(self):
+        return False
+
+
+def run(images=None, repeat=3, steps=12, radii=(0.5, 1.0), settling=0):
+    """Time a whole `AppAddon.characterize` run with the serial writes and the
+    camera captures stubbed, so only the processing is measured. With a
+    `settling` time in ms, the characterization waits for it after every
+    write, as in a real run.
+    """
+    corpus = load_corpus(images)
+    frames = itertools.cycle(corpus)
+    addon = AppAddon(addon_path=os.path.abspath('addons/camera'))
+    dev = addon.deviation
+    dev.rect = centered_rect(corpus[0], 200)
+
+    def frame(device):
+        return next(frames)
+
+    def serial_write(data, priority=None):
+        return {'success': True, 'data': None, 'info': None}
+
+    addon.frame = frame
+    cherrypy.engine.subscribe('serial-write', serial_write)
+    cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            # the result file is written to the working directory
+            os.chdir(tmp)
+            durations = timeit(
+                lambda: addon._characterize(StubJob(), 'stub', None, None,
+                                            steps, list(radii),
+                                            settling=settling),
+                repeat, warmup=0)
+    finally:
+        os.chdir(cwd)
+        cherrypy.engine.unsubscribe('serial-write', serial_write)
+    points = steps * len(radii)
+    results = [summarize('characterize', durations, steps=steps,
+                         radii=list(radii), settling=settling,
+                         corpus=images or 'synthetic')]
+    results.append(summarize('characterize.per_point', durations / points,
+                             steps=steps, radii=list(radii), settling=settling,
+                             corpus=images or 'synthetic'))
+    return results
@@ -0,0 +1,88 @@
+import itertools
+import os
+
+import numpy as np
+
+from addons.camera.deviation import Deviation
+from benchmarks.common import summarize, synthetic_frame, timeit
+
+ROI_SIZES = (100, 200, 400)
+SPOT_SIZES = (15, 50)
+
+
+def load_corpus(images=None, count=20, seed=0):
+    """Frames to process, read from the jpeg files in the `images` folder, or
+    synthetic ones with the spot at random positions if not given.
+    """
+    if images:
+        from skimage.io import imread
+        names = sorted(name for name in os.listdir(images)
+                       if name.lower().endswith(('.jpg', '.jpeg')))
+        if not names:
+            raise ValueError('No jpeg images in {}'.format(images))
+        return [imread(os.path.join(images, name)) for name in names]
+    rng = np.random.default_rng(seed)
+    return [synthetic_frame(spot=(240 + rng.integers(-40, 40),
+                                  320 + rng.integers(-40, 40)), rng=rng)
+            for _ in range(count)]
+
+
+def centered_rect(frame, size):
+    """Calibration rect of `size` pixels per side at the center of `frame`."""
+    height, width = frame.shape[:2]
+    size = min(size, height, width)
+    top, left = (height - size) // 2, (width - size) // 2
+    return [(left, top), (left + size - 1, top + size - 1)]
+
+
+def run(images=None, repeat=50):
+    """Time `Deviation.findspot` for several ROI and spot sizes."""
+    corpus = load_corpus(images)
+    dev = Deviation('')
+    results = []
+    for roi, spotsize in itertools.product(ROI_SIZES, SPOT_SIZES):
+        frames = itertools.cycle(corpus)
+        dev.rect = centered_rect(corpus[0], roi)
+
+        def findspot():
+            dev.image = next(frames)
+            dev.findspot(None, spotsize)
+
+        results.append(summarize('findspot', timeit(findspot, repeat),
+                                 roi=roi, spotsize=spotsize,
+                                 corpus=images or 'synthetic'))
+    results.extend(run_tracking(repeat))
+    return results
+
+
+def drifting_corpus(count=20, step=3, seed=0):
+    """Synthetic frames with the spot moving `step` pixels at a time, as it
+    does between the points of a characterization.
+    """
+    rng = np.random.default_rng(seed)
+    return [synthetic_frame(spot=(200 + step * k, 280 + step * k), rng=rng)
+            for k in range(count)]
+
+
+def run_tracking(repeat=50):
+    """Time `Deviation.findspot` with tracking on a drifting spot, against
+    the full search of the same frames.
+    """
+    corpus = drifting_corpus()
+    results = []
+    for roi, tracking in itertools.product(ROI_SIZES, (False, True)):
+        dev = Deviation('', tracking=tracking)
+        dev.rect = centered_rect(corpus[0], roi)
+        frames = itertools.cycle(corpus)
+        paths = []
+
+        def findspot():
+            dev.image = next(frames)
+            dev.findspot(None, 15)
+            paths.append(dev.last_path)
+
+        durations = timeit(findspot, repeat)
+        results.append(summarize('findspot_tracking', durations, roi=roi,
+                                 tracking=tracking,
+                                 window_hits=paths.count('window')))
+    return results
@@ -0,0 +1,52 @@
+import itertools
+
+from benchmarks.common import summarize, timeit
+from modules.emulator import EmulatedBoard
+from modules.serial_controller import Arduino
+
+
+def run(repeat=200, latency=0.0, baudrate=57600):
+    """Time the commands of `Arduino.serial_write` against an emulated board,
+    from the Python call until the reply is parsed. Commands without a reply
+    are timed until their bytes are written.
+
+    Note that connecting takes a few seconds, since pyFirmata waits for the
+    board to reset.
+    """
+    board = EmulatedBoard(latency=latency, baudrate=baudrate)
+    board.start()
+    ard = Arduino(board.port)
+    connected, info = ard.connect()
+    if not connected:
+        board.stop()
+        raise RuntimeError(info)
+    params = {'latency': latency, 'baudrate': baudrate}
+    results = []
+    try:
+        # alternate the values, unchanged outputs are not sent
+        values = itertools.cycle(([0.25] * 4, [0.75] * 4))
+        results.append(summarize('serial.vset', timeit(
+            lambda: ard.serial_write('vset', [(3, 9, 10, 11), next(values)]),
+            repeat), **params))
+        results.append(summarize('serial.vread', timeit(
+            lambda: ard.serial_write('vread', [(0, 1, 2, 3, 4, 5)]),
+            repeat), **params))
+        results.append(summarize('serial.vread_oversampled', timeit(
+            lambda: ard.serial_write('vread', [(0, 1, 2, 3, 4, 5), 16]),
+            repeat), samples=16, **params))
+        results.append(summarize('serial.vread_multi', timeit(
+            lambda: ard.serial_write('vread_multi', [[(0, 1)] * 8]),
+            repeat), reads=8, **params))
+        states = itertools.cycle(('a', 'b'))
+        results.append(summarize('serial.sw_control', timeit(
+            lambda: ard.serial_write('sw_control', [next(states)]),
+            repeat), **params))
+        steps = 100
+        sweep = [[i / steps for i in range(steps)], [0.5] * steps]
+        results.append(summarize('serial.sweep', timeit(
+            lambda: ard.serial_write('sweep', [(3, 9), (0, 1), sweep, 0]),
+            max(1, repeat // 20)), steps=steps, **params))
+    finally:
+        ard.disconnect()
+        board.stop()
+    return results
@@ -0,0 +1,48 @@
+import time
+
+import numpy as np
+
+
+def timeit(fun, repeat, warmup=1):
+    """Call `fun` `repeat` times after `warmup` untimed calls.
+
+    Returns:
+        numpy array with the duration of each call in seconds
+    """
+    for _ in range(warmup):
+        fun()
+    durations = np.empty(repeat)
+    for i in range(repeat):
+        start = time.perf_counter()
+        fun()
+        durations[i] = time.perf_counter() - start
+    return durations
+
+
+def summarize(name, durations, **params):
+    """Latency percentiles and throughput of a set of timed calls, as a dict
+    ready to be dumped as json.
+    """
+    ms = durations * 1000
+    return {'name': name,
+            'params': params,
+            'n': len(durations),
+            'mean_ms': float(np.mean(ms)),
+            'p50_ms': float(np.percentile(ms, 50)),
+            'p90_ms': float(np.percentile(ms, 90)),
+            'p99_ms': float(np.percentile(ms, 99)),
+            'max_ms': float(np.max(ms)),
+            'throughput_per_s': float(len(durations) / np.sum(durations))}
+
+
+def synthetic_frame(height=480, width=640, spot=(240, 320), radius=4,
+                    noise=20, rng=None):
+    """RGB frame with a gaussian laser spot of the given `radius` in pixels
+    centered at `spot` (row, col) over a noisy dark background.
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    frame = rng.normal(40, noise, (height, width, 3))
+    rows, cols = np.ogrid[:height, :width]
+    dist2 = (rows - spot[0])**2 + (cols - spot[1])**2
+    frame[..., 0] += 215 * np.exp(-dist2 / (2 * radius**2))
+    return np.clip(frame, 0, 255).astype(np.uint8)
@@ -0,0 +1,76 @@
+"""Run the benchmarks and print the results as json.
+
+Usage, from the repository root:
+
+    python -m benchmarks.run [--only serial,findspot,characterize] [--images DIR]
+"""
+import argparse
+import contextlib
+import json
+import platform
+import sys
+import time
+
+SUITES = ('serial', 'findspot', 'characterize')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--only", type=str, default=','.join(SUITES), action="store",
+        help="comma separated suites to run, among " + ', '.join(SUITES))
+    parser.add_argument(
+        "--images", type=str, default=None, action="store",
+        help="folder of jpeg images to process, synthetic frames are used otherwise")
+    parser.add_argument(
+        "--repeat", type=int, default=None, action="store",
+        help="timed calls per benchmark")
+    parser.add_argument(
+        "--latency", type=float, default=0.0, action="store",
+        help="emulated serial link latency in seconds")
+    parser.add_argument(
+        "--baudrate", type=int, default=57600, action="store",
+        help="emulated serial link baud rate, 0 for unlimited")
+    parser.add_argument(
+        "-o", "--output", type=str, default=None, action="store",
+        help="file to write the results to, instead of stdout")
+    args = parser.parse_args()
+
+    suites = [name.strip() for name in args.only.split(',') if name.strip()]
+    repeat = {} if args.repeat is None else {'repeat': args.repeat}
+    # keep stdout clean for the json output
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run_suites(parser, args, suites, repeat)
+    report = {'timestamp': time.time(),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+
+def run_suites(parser, args, suites, repeat):
+    results = []
+    for name in suites:
+        if name == 'serial':
+            from benchmarks import bench_serial
+            results += bench_serial.run(latency=args.latency,
+                                        baudrate=args.baudrate or None,
+                                        **repeat)
+        elif name == 'findspot':
+            from benchmarks import bench_findspot
+            results += bench_findspot.run(images=args.images, **repeat)
+        elif name == 'characterize':
+            from benchmarks import bench_characterize
+            results += bench_characterize.run(images=args.images, **repeat)
+        else:
+            parser.error('unknown suite: ' + name)
+    return results
+
+
+if __name__ == '__main__':
+    main()
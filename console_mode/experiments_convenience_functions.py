@@ -10,14 +10,14 @@ def main():
   return ard
 
 def cycle_pulses(pulse_duration, delay):
-  # Alternate the direction of the current through the two outputs
+  # Alternate the direction of the current through the two outputs. The pulses
+  # are timed by the board, this loop only waits for the user to stop them
+  ard.pulse_train('ab', pulse_duration, delay, count=0)
   try:
     while True:
-      ard._sw_control('pulse_a', pulse_duration)
-      time.sleep(delay)
-      ard._sw_control('pulse_b', pulse_duration)
-      time.sleep(delay)
+      time.sleep(0.1)
   except KeyboardInterrupt:
+    ard.pulse_stop()
     ard._sw_control('z')
     print('Back to HI-Z')
 
@@ -1,3 +1,6 @@
+from modules.plugin_serialobject import PRIORITY_BULK
+
+
 class Script(object):
     """
     Base scripting class that must be sublcassed by any custom script
@@ -5,6 +8,8 @@ class Script(object):
     def __init__(self, cherry):
         self.cherrypy = cherry
         self.data = None
+        # `Job` handle when running in the background, see `JobPlugin`
+        self.job = None
 
     def run(self, **kwargs):
         """
@@ -15,6 +20,22 @@ class Script(object):
     def serial_write(self, cmd, params=[]):
         """
         Convenience function to write to the serial device. It uses the
-        `SerialObjectPlugin`.
+        `SerialObjectPlugin`, with a lower priority than interactive commands.
+        """
+        return self.cherrypy.engine.publish('serial-write', [cmd] + list(params),
+                                            PRIORITY_BULK)[0]
+
+    def report(self, progress=None, *partial):
+        """
+        Convenience function to publish the progress (0..1) and partial
+        results of the script while it runs as a job.
+        """
+        if self.job:
+            self.job.report(progress, *partial)
+
+    def cancelled(self):
+        """
+        Whether the script was requested to stop. Long loops should check it
+        on every iteration.
         """
-        return self.cherrypy.engine.publish('serial-write', [cmd] + params)[0]
+        return self.job.cancelled() if self.job else False
@@ -0,0 +1,384 @@
+import heapq
+import itertools
+import math
+import os
+import pty
+import random
+import select
+import threading
+import time
+import tty
+
+import pyfirmata
+
+from modules.serial_controller import (
+    REPORT_ANALOG_NOW_QUERY, REPORT_ANALOG_NOW_RESPONSE, SWEEP_CONFIG,
+    SWEEP_DATA, SWEEP_STOP, SWEEP_RESULT, SWEEP_BUFFER_SIZE, PULSE_TRAIN,
+    PULSE_STOP, PULSE_DONE, ANALOG_READ_TIME)
+
+FIRMATA_VERSION = (2, 3)
+MINIMUM_SAMPLING_INTERVAL = 10    # ms
+TOTAL_ANALOG_PINS = 6
+BITS_PER_BYTE = 10    # start, 8 data and stop bits on the wire
+
+
+def sine(frequency=1.0, phase=0.0, offset=0.5, amplitude=0.4):
+    """Synthetic signal factory, returning a function of the time in seconds
+    with values in the range 0..1.
+    """
+    def signal(t):
+        return offset + amplitude * math.sin(2 * math.pi * frequency * t + phase)
+    return signal
+
+
+class EmulatedBoard(object):
+    """Emulated Arduino running ExtendedStandardFirmata.
+
+    The emulator opens a pseudo terminal and speaks on it the subset of Firmata
+    used by `Arduino`, including the custom SysEx commands. Since it looks like
+    any other serial device, it is used by giving its `port` to `Arduino`:
+
+        board = EmulatedBoard(latency=0.001)
+        board.start()
+        ard = Arduino(board.port)
+        ard.connect()
+
+    The link latency and baud rate are emulated, and the analog inputs follow
+    synthetic signals, so the timing of the serial path can be measured without
+    any hardware. Only works on POSIX systems.
+    """
+    def __init__(self, latency=0.0, baudrate=57600, signals=None, noise=0.0):
+        """
+        Args:
+            latency (float): seconds added to every message in each direction
+            baudrate (int): bits per second of the emulated link, or None for
+                an unlimited throughput
+            signals (dict): keys: analog pins, values: functions of the time in
+                seconds returning the pin value in the range 0..1. Pins not
+                given follow a 1 Hz sine wave with a different phase each
+            noise (float): standard deviation of the gaussian noise added to
+                every analog reading, in the range 0..1
+        """
+        self.latency = latency
+        self.baudrate = baudrate
+        self.signals = {pin: sine(phase=pin) for pin in range(TOTAL_ANALOG_PINS)}
+        self.signals.update(signals or {})
+        self.noise = noise
+        self.port = None
+        # state of the emulated board
+        self.pin_modes = {}
+        self.digital = {}    # keys: digital pins, values: 0 or 1
+        self.pwm = {}    # keys: PWM pins, values: 0..255
+        self.reporting = set()    # analog pins being reported
+        self.sampling_interval = 19    # ms
+        # (time, pattern) of every change of the pulse pins, see `pulse_train`
+        self.pulse_log = []
+        self._master = None
+        self._slave = None
+        self._thread = None
+        self._running = False
+        self._start_time = None
+        # scheduled board events, (time, seq, function, args)
+        self._events = []
+        self._seq = itertools.count()
+        # times at which the link is free in each direction
+        self._rx_free = 0.0
+        self._tx_free = 0.0
+        self._parser = self._parse()
+        next(self._parser)
+        self._reset_state()
+
+    def start(self):
+        """Open the pseudo terminal and start emulating. The device path to
+        connect to is then available as `port`.
+        """
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._start_time = time.monotonic()
+        self._running = True
+        self._schedule(self._start_time, self._report_analog)
+        self._thread = threading.Thread(target=self._loop, name='emulated-board')
+        self._thread.daemon = True
+        self._thread.start()
+        return self.port
+
+    def stop(self):
+        self._running = False
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        for fd in (self._master, self._slave):
+            if fd is not None:
+                os.close(fd)
+        self._master = self._slave = None
+
+    def analog_value(self, pin, now=None):
+        """Current value of an analog input, as a 10-bit integer."""
+        now = time.monotonic() if now is None else now
+        value = self.signals[pin](now - self._start_time)
+        if self.noise:
+            value += random.gauss(0, self.noise)
+        return int(round(min(max(value, 0.0), 1.0) * 1023))
+
+    # link emulation
+
+    def _byte_time(self, nbytes):
+        if not self.baudrate:
+            return 0.0
+        return nbytes * BITS_PER_BYTE / self.baudrate
+
+    def _schedule(self, when, fun, *args):
+        heapq.heappush(self._events, (when, next(self._seq), fun, args))
+
+    def _send(self, now, data):
+        """Queue `data` from the board to the host."""
+        start = max(now, self._tx_free)
+        self._tx_free = start + self._byte_time(len(data))
+        self._schedule(self._tx_free + self.latency, self._deliver, bytes(data))
+
+    def _deliver(self, now, data):
+        try:
+            os.write(self._master, data)
+        except OSError:
+            pass
+
+    def _loop(self):
+        while self._running:
+            now = time.monotonic()
+            while self._events and self._events[0][0] <= now:
+                _, _, fun, args = heapq.heappop(self._events)
+                fun(now, *args)
+            timeout = 0.05
+            if self._events:
+                timeout = min(timeout, max(0.0, self._events[0][0] - time.monotonic()))
+            try:
+                readable, _, _ = select.select([self._master], [], [], timeout)
+            except (OSError, ValueError):
+                break
+            if not readable:
+                continue
+            try:
+                data = os.read(self._master, 1024)
+            except OSError:
+                continue
+            received = time.monotonic()
+            for byte in data:
+                message = self._parser.send(byte)
+                if message is not None:
+                    # the message reaches the board once all its bytes are in
+                    arrival = max(received + self.latency, self._rx_free)
+                    arrival += self._byte_time(len(message[1]) + 1)
+                    self._rx_free = arrival
+                    self._schedule(arrival, self._process, message)
+
+    # Firmata protocol
+
+    def _parse(self):
+        """Coroutine fed with the received bytes one at a time. Yields
+        (command, data) tuples when a message is complete, and None otherwise.
+        """
+        lengths = {pyfirmata.DIGITAL_MESSAGE: 2, pyfirmata.ANALOG_MESSAGE: 2,
+                   pyfirmata.REPORT_ANALOG: 1, pyfirmata.REPORT_DIGITAL: 1,
+                   pyfirmata.SET_PIN_MODE: 2, pyfirmata.REPORT_VERSION: 0,
+                   pyfirmata.SYSTEM_RESET: 0}
+        message = None
+        while True:
+            byte = yield message
+            message = None
+            if byte == pyfirmata.START_SYSEX:
+                data = bytearray()
+                byte = yield None
+                while byte != pyfirmata.END_SYSEX:
+                    data.append(byte)
+                    byte = yield None
+                if data:
+                    message = (pyfirmata.START_SYSEX, data)
+                continue
+            command = byte if byte >= 0xF0 else byte & 0xF0
+            if command not in lengths:
+                continue
+            data = bytearray()
+            if byte < 0xF0:
+                # the channel (pin or port) is part of the command byte
+                data.append(byte & 0x0F)
+            for _ in range(lengths[command]):
+                byte = yield None
+                data.append(byte)
+            message = (command, data)
+
+    def _process(self, now, message):
+        command, data = message
+        if command == pyfirmata.DIGITAL_MESSAGE:
+            port, value = data[0], data[1] + (data[2] << 7)
+            for i in range(8):
+                pin = port * 8 + i
+                if self.pin_modes.get(pin) in (pyfirmata.OUTPUT, pyfirmata.INPUT):
+                    self.digital[pin] = (value >> i) & 1
+        elif command == pyfirmata.ANALOG_MESSAGE:
+            pin, value = data[0], data[1] + (data[2] << 7)
+            if self.pin_modes.get(pin) == pyfirmata.PWM:
+                self.pwm[pin] = value
+        elif command == pyfirmata.REPORT_ANALOG:
+            pin, enable = data[0], data[1]
+            if enable:
+                self.reporting.add(pin)
+            else:
+                self.reporting.discard(pin)
+        elif command == pyfirmata.SET_PIN_MODE:
+            pin, mode = data[0], data[1]
+            self.pin_modes[pin] = mode
+            if mode == pyfirmata.PWM:
+                self.pwm[pin] = 0
+            elif mode == pyfirmata.OUTPUT:
+                self.digital[pin] = 0
+        elif command == pyfirmata.REPORT_VERSION:
+            self._send(now, bytes((pyfirmata.REPORT_VERSION,) + FIRMATA_VERSION))
+        elif command == pyfirmata.SYSTEM_RESET:
+            self._reset_state()
+        elif command == pyfirmata.START_SYSEX:
+            self._process_sysex(now, data[0], data[1:])
+
+    def _process_sysex(self, now, command, argv):
+        if command == pyfirmata.SAMPLING_INTERVAL and len(argv) > 1:
+            self.sampling_interval = max(argv[0] + (argv[1] << 7),
+                                         MINIMUM_SAMPLING_INTERVAL)
+        elif command == pyfirmata.REPORT_FIRMWARE:
+            name = bytearray()
+            for char in b'EmulatedFirmata':
+                name.extend((char & 0x7F, char >> 7))
+            self._send(now, bytes((pyfirmata.START_SYSEX, pyfirmata.REPORT_FIRMWARE)
+                                  + FIRMATA_VERSION) + name
+                       + bytes((pyfirmata.END_SYSEX,)))
+        elif command == REPORT_ANALOG_NOW_QUERY:
+            self._report_analog_now(now, argv)
+        elif command == SWEEP_CONFIG and len(argv) > 5:
+            self._sweep = {'settling': argv[0] + (argv[1] << 7),
+                           'steps': argv[2] + (argv[3] << 7),
+                           'inputs': argv[4], 'outputs': list(argv[5:]),
+                           'table': [], 'step': 0, 'settling_now': False}
+            self._run_sweep(now)
+        elif command == SWEEP_DATA and self._sweep:
+            table = self._sweep['table']
+            for i in range(0, len(argv) - 1, 2):
+                if len(table) >= SWEEP_BUFFER_SIZE:
+                    break
+                table.append(argv[i] + (argv[i+1] << 7))
+            self._run_sweep(now)
+        elif command == SWEEP_STOP:
+            self._sweep = None
+        elif command == PULSE_TRAIN and len(argv) > 12:
+            self._pulses = {'pins': list(argv[:4]), 'mode': argv[4],
+                            'width': (argv[5] + (argv[6] << 7) + (argv[7] << 14)) / 1e6,
+                            'gap': (argv[8] + (argv[9] << 7) + (argv[10] << 14)) / 1e6,
+                            'count': argv[11] + (argv[12] << 7), 'done': 0,
+                            'id': next(self._seq)}
+            self._pulse_edge(now, self._pulses['id'], True)
+        elif command == PULSE_STOP and self._pulses:
+            self._end_pulses(now)
+
+    def _reset_state(self):
+        self.pin_modes = {}
+        self.digital = {}
+        self.pwm = {}
+        self.reporting = set()
+        self._sweep = None
+        self._pulses = None
+
+    def _report_analog(self, now):
+        """Periodic analog reports, as done by the main loop of the firmware."""
+        if not self._running:
+            return
+        for pin in sorted(self.reporting):
+            value = self.analog_value(pin, now)
+            self._send(now, bytes((pyfirmata.ANALOG_MESSAGE + pin,
+                                   value & 0x7F, value >> 7)))
+        self._schedule(now + self.sampling_interval / 1000, self._report_analog)
+
+    def _report_analog_now(self, now, argv):
+        pins = argv[0]
+        tag = argv[1] if len(argv) > 1 else 0
+        samples = argv[2] if len(argv) > 2 and argv[2] > 1 else 1
+        response = bytearray((pyfirmata.START_SYSEX, REPORT_ANALOG_NOW_RESPONSE,
+                              tag & 0x7F, samples))
+        done = now
+        for pin in range(7):
+            if not pins & (1 << pin) or pin not in self.signals:
+                continue
+            response.append(pin)
+            values = []
+            for _ in range(samples):
+                values.append(self.analog_value(pin, done))
+                done += ANALOG_READ_TIME
+            if samples == 1:
+                response.extend((values[0] & 0x7F, values[0] >> 7))
+            else:
+                total, low, high = sum(values), min(values), max(values)
+                response.extend((total & 0x7F, (total >> 7) & 0x7F, total >> 14,
+                                 low & 0x7F, low >> 7, high & 0x7F, high >> 7))
+        response.append(pyfirmata.END_SYSEX)
+        self._send(done, response)
+
+    def _run_sweep(self, now):
+        """Apply the next sweep step if its values are in the table."""
+        sweep = self._sweep
+        if not sweep or sweep['settling_now']:
+            return
+        if sweep['step'] >= sweep['steps']:
+            self._sweep = None
+            return
+        if len(sweep['table']) < len(sweep['outputs']):
+            return
+        for pin in sweep['outputs']:
+            value = sweep['table'].pop(0)
+            if self.pin_modes.get(pin) == pyfirmata.PWM:
+                self.pwm[pin] = value
+        sweep['settling_now'] = True
+        self._schedule(now + sweep['settling'] / 1000, self._sweep_result, sweep)
+
+    def _sweep_result(self, now, sweep):
+        if sweep is not self._sweep:
+            # stopped or restarted meanwhile
+            return
+        step = sweep['step']
+        response = bytearray((pyfirmata.START_SYSEX, SWEEP_RESULT,
+                              step & 0x7F, (step >> 7) & 0x7F))
+        for pin in range(7):
+            if sweep['inputs'] & (1 << pin) and pin in self.signals:
+                value = self.analog_value(pin, now)
+                response.extend((value & 0x7F, value >> 7))
+        response.append(pyfirmata.END_SYSEX)
+        self._send(now, response)
+        sweep['settling_now'] = False
+        sweep['step'] += 1
+        self._run_sweep(now)
+
+    def _write_pulse_pins(self, now, pattern):
+        for i, pin in enumerate(self._pulses['pins']):
+            self.digital[pin] = (pattern >> i) & 1
+        self.pulse_log.append((now, pattern))
+
+    def _pulse_edge(self, now, train, rising):
+        pulses = self._pulses
+        if not pulses or pulses['id'] != train:
+            return
+        if rising:
+            state = pulses['done'] & 1 if pulses['mode'] == 2 else pulses['mode']
+            # patterns (a,b,c,d) for states 'a' (1,0,0,1) and 'b' (0,1,1,0)
+            self._write_pulse_pins(now, 0b1001 if state == 0 else 0b0110)
+            self._schedule(now + pulses['width'], self._pulse_edge, train, False)
+        else:
+            self._write_pulse_pins(now, 0)
+            pulses['done'] += 1
+            if pulses['count'] and pulses['done'] >= pulses['count']:
+                self._end_pulses(now)
+            else:
+                self._schedule(now + pulses['gap'], self._pulse_edge, train, True)
+
+    def _end_pulses(self, now):
+        done = self._pulses['done']
+        self._write_pulse_pins(now, 0)
+        self._pulses = None
+        self._send(now, bytes((pyfirmata.START_SYSEX, PULSE_DONE,
+                               done & 0x7F, (done >> 7) & 0x7F,
+                               pyfirmata.END_SYSEX)))
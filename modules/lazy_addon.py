@@ -0,0 +1,89 @@
+import ast
+import importlib
+import os
+import threading
+import time
+
+import cherrypy
+
+
+def read_addon_metadata(filename):
+    """Read the `ADDON_CONF` dict of an addon module, and the names of the
+    handlers exposed by its `AppAddon`, without importing it.
+
+    Returns:
+        (addon_conf, handler names), or None if the module doesn't define
+        `ADDON_CONF` as a literal
+    """
+    with open(filename, 'r') as f:
+        tree = ast.parse(f.read(), filename)
+    addon_conf = None
+    handlers = set()
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(
+                isinstance(target, ast.Name) and target.id == 'ADDON_CONF'
+                for target in node.targets):
+            try:
+                addon_conf = ast.literal_eval(node.value)
+            except ValueError:
+                return None
+        elif isinstance(node, ast.ClassDef) and node.name == 'AppAddon':
+            for item in node.body:
+                if isinstance(item, ast.FunctionDef) and \
+                        any(_is_expose(d) for d in item.decorator_list):
+                    handlers.add(item.name)
+    if addon_conf is None:
+        return None
+    return addon_conf, handlers
+
+
+def _is_expose(decorator):
+    if isinstance(decorator, ast.Call):
+        decorator = decorator.func
+    if isinstance(decorator, ast.Attribute):
+        return decorator.attr == 'expose'
+    return isinstance(decorator, ast.Name) and decorator.id == 'expose'
+
+
+class LazyAddon(object):
+    """Stand-in mounted in place of an addon, which imports the addon module
+    and instantiates its `AppAddon` on the first request, or on `load`.
+
+    Until the addon is loaded, only its exposed `handlers` are forwarded, so
+    that cherrypy can inspect the proxy, e.g. when mounting it or dispatching
+    its static files, without loading the addon.
+    """
+    def __init__(self, module_name, addon_conf, handlers):
+        self.module_name = module_name
+        self.addon_conf = addon_conf
+        self.handlers = handlers
+        self._addon = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._addon is None:
+            with self._lock:
+                if self._addon is None:
+                    start = time.perf_counter()
+                    module = importlib.import_module(self.module_name)
+                    self._addon = module.AppAddon()
+                    cherrypy.engine.log('Loaded addon {} in {:.2f} s'.format(
+                        self.module_name, time.perf_counter() - start))
+        return self._addon
+
+    def cpconf(self, addon_path):
+        """Mount configuration, serving the `static` folder of the addon
+        conf, relative to `addon_path`, as the addon itself does.
+        """
+        conf = {'/': {'tools.staticdir.root': os.path.abspath(os.getcwd())}}
+        if 'static' in self.addon_conf:
+            conf['/static'] = {
+                'tools.staticdir.on': True,
+                'tools.staticdir.dir': os.path.join(addon_path,
+                                                    self.addon_conf['static'])}
+        return conf
+
+    def __getattr__(self, name):
+        if self._addon is None and name not in self.handlers:
+            raise AttributeError(name)
+        return getattr(self.load(), name)
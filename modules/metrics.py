@@ -0,0 +1,124 @@
+import bisect
+import functools
+import threading
+import time
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    """Registry of counters and latency histograms, rendered in the Prometheus
+    text exposition format.
+
+    Metrics are identified by their name and labels, given as keyword
+    arguments. Values kept elsewhere can be exported with collectors, i.e.
+    functions returning (name, labels dict, value) tuples, called on
+    rendering only.
+    """
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.help = {}
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def instrument(self, prefix, fun, **labels):
+        """Wrap `fun` to count its calls and exceptions and to observe its
+        latency, as `<prefix>_total`, `<prefix>_errors_total` and
+        `<prefix>_seconds`.
+        """
+        @functools.wraps(fun)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fun(*args, **kwargs)
+            except Exception:
+                self.inc(prefix + '_errors_total', **labels)
+                raise
+            finally:
+                self.observe(prefix + '_seconds',
+                             time.perf_counter() - start, **labels)
+                self.inc(prefix + '_total', **labels)
+        return wrapper
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        """Text exposition of all the metrics."""
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(
+                (key, list(h.counts), h.sum, h.count, h.buckets)
+                for key, h in self.histograms.items())
+        for collector in self.collectors:
+            for name, labels, value in collector():
+                counters.append(((name, tuple(sorted(labels.items()))), value))
+        counters.sort()
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in self.help:
+                    lines.append('# HELP {} {}'.format(name, self.help[name]))
+                lines.append('# TYPE {} {}'.format(name, kind))
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append('{}{} {}'.format(name, _labels(labels), value))
+        for (name, labels), counts, total, count, buckets in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, n in zip(buckets, counts):
+                cumulative += n
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('{}_bucket{} {}'.format(
+                    name, _labels(labels + (('le', le),)), cumulative))
+            lines.append('{}_sum{} {}'.format(name, _labels(labels), total))
+            lines.append('{}_count{} {}'.format(name, _labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"'))
+                          for k, v in labels) + '}'
+
+
+# registry shared by the whole application
+registry = Metrics()
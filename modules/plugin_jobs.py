@@ -0,0 +1,158 @@
+import collections
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cherrypy.process import plugins
+from modules.metrics import registry
+
+
+class Job(object):
+    """Handle given to the function run by a job.
+
+    Long running functions should call `report` to publish their progress and
+    partial results, and check `cancelled` often enough to stop in time.
+    """
+    def __init__(self, job_id, name, on_update=None):
+        self.id = job_id
+        self.name = name
+        # called with the job whenever its state or progress changes
+        self.on_update = on_update
+        self.state = 'pending'
+        self.progress = 0.0
+        self.partial = []
+        self.result = None
+        self.info = None
+        self._cancel = threading.Event()
+        self._lock = threading.Lock()
+
+    def report(self, progress=None, *partial):
+        """Update the progress (0..1) and append any partial results."""
+        with self._lock:
+            if progress is not None:
+                self.progress = progress
+            self.partial.extend(partial)
+        self.updated()
+
+    def updated(self):
+        if self.on_update is not None:
+            self.on_update(self)
+
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def cancel(self):
+        self._cancel.set()
+
+    def is_finished(self):
+        return self.state in ('done', 'failed', 'cancelled')
+
+    def status(self, since=0):
+        """Job state as a dict, with the partial results from index `since`
+        so that pollers only get what they have not seen yet.
+        """
+        with self._lock:
+            return {'id': self.id,
+                    'name': self.name,
+                    'state': self.state,
+                    'progress': self.progress,
+                    'since': since,
+                    'partial': self.partial[since:],
+                    'result': self.result,
+                    'info': self.info}
+
+
+class JobPlugin(plugins.SimplePlugin):
+    """Runs long operations, such as scripts and characterizations, on a
+    bounded pool of threads so they don't hold the server's request threads.
+
+    Jobs are submitted through the `job-submit` channel with a name and a
+    function taking the `Job` handle as its first argument, and are tracked by
+    the returned id. Their updates are published on the `job-update` channel.
+    """
+    def __init__(self, bus, max_workers=2, keep=50):
+        plugins.SimplePlugin.__init__(self, bus)
+        self.max_workers = max_workers
+        # finished jobs kept around for their results
+        self.keep = keep
+        self.jobs = collections.OrderedDict()
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def start(self):
+        self.bus.log('Instantiating jobs plugin')
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        for channel, fun in (("job-submit", self.submit),
+                             ("job-status", self.status),
+                             ("job-cancel", self.cancel),
+                             ("job-list", self.list)):
+            self.bus.subscribe(channel, registry.instrument(
+                'bus_channel', fun, channel=channel))
+
+    def stop(self):
+        self.bus.log('Deleting jobs plugin')
+        with self._lock:
+            jobs = list(self.jobs.values())
+        for job in jobs:
+            job.cancel()
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def submit(self, name, fun, *args, **kwargs):
+        """Queue `fun(job, *args, **kwargs)`.
+
+        Returns:
+            int: job id
+        """
+        with self._lock:
+            job = Job(next(self._ids), name, self._publish_update)
+            self.jobs[job.id] = job
+            self._forget_finished()
+        self._executor.submit(self._run, job, fun, args, kwargs)
+        return job.id
+
+    def _run(self, job, fun, args, kwargs):
+        if job.cancelled():
+            job.state = 'cancelled'
+            job.updated()
+            return
+        job.state = 'running'
+        job.updated()
+        try:
+            job.result = fun(job, *args, **kwargs)
+        except Exception as e:
+            self.bus.log('ERROR job {} {}: {}'.format(job.id, job.name, e))
+            job.info = str(e)
+            job.state = 'failed'
+        else:
+            job.state = 'cancelled' if job.cancelled() else 'done'
+        registry.inc('jobs_finished_total', state=job.state)
+        job.updated()
+
+    def _publish_update(self, job):
+        self.bus.publish('job-update', job)
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self.jobs.items()
+                    if job.is_finished()]
+        for job_id in finished[:max(0, len(finished) - self.keep)]:
+            del self.jobs[job_id]
+
+    def status(self, job_id, since=0):
+        job = self.jobs.get(job_id)
+        return job.status(since) if job else None
+
+    def cancel(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
+            return False
+        job.cancel()
+        return True
+
+    def list(self):
+        with self._lock:
+            jobs = list(self.jobs.values())
+        return [{'id': job.id, 'name': job.name, 'state': job.state,
+                 'progress': job.progress} for job in jobs]
@@ -0,0 +1,157 @@
+import collections
+import itertools
+import threading
+import time
+
+from cherrypy.process import plugins
+from modules.metrics import registry
+from modules.plugin_serialobject import PRIORITY_BULK
+
+
+class PushClient(object):
+    """Queue of the events waiting to be sent to one connected browser.
+
+    Events are keyed, and a new event replaces the pending one with the same
+    key, so that a slow client gets the latest state instead of a backlog.
+    The queue is bounded by `size`; when full, the oldest event is dropped.
+    """
+    def __init__(self, client_id, size=100):
+        self.id = client_id
+        self.size = size
+        self.closed = False
+        self._events = collections.OrderedDict()
+        self._cond = threading.Condition()
+
+    def put(self, key, event, data):
+        with self._cond:
+            if key in self._events:
+                del self._events[key]
+            elif len(self._events) >= self.size:
+                self._events.popitem(last=False)
+                registry.inc('push_events_dropped_total')
+            self._events[key] = (event, data)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """Wait for events, and take all the pending ones.
+
+        Returns:
+            list of (event, data), empty if none came in `timeout`, or None
+            once the client is closed
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._events or self.closed, timeout)
+            if self.closed:
+                return None
+            events = list(self._events.values())
+            self._events.clear()
+            return events
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+
+
+class PushPlugin(plugins.SimplePlugin):
+    """Fans out events to the connected browsers, see the `/events` handler.
+
+    Events are published on the `push-publish` channel with a name, json
+    serializable data and optionally a key (the name by default) for
+    coalescing. The plugin itself pushes:
+
+        connection  {'connected'} when the board connects or disconnects
+        job         {'id', 'name', 'state', 'progress'} on every job update
+        readings    {'time', 'pins', 'values'} analog reads of `pins`, taken
+                    `rate` times per second by a single loop, and only while
+                    someone is listening and the board is connected
+
+    Args:
+        pins (int list): analog pins read for the readings
+        rate (float): readings per second, 0 to disable them
+        queue_size (int): events kept per client
+    """
+    def __init__(self, bus, pins=(0, 1, 2, 3), rate=2.0, queue_size=100):
+        plugins.SimplePlugin.__init__(self, bus)
+        self.pins = list(pins)
+        self.rate = rate
+        self.queue_size = queue_size
+        self.clients = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.bus.log('Instantiating push plugin')
+        for channel, fun in (("push-publish", self.publish),
+                             ("push-subscribe", self.subscribe_client),
+                             ("push-unsubscribe", self.unsubscribe_client),
+                             ("serial-just-connected",
+                              lambda: self.publish_connection(True)),
+                             ("serial-just-disconnected",
+                              lambda: self.publish_connection(False)),
+                             ("job-update", self.publish_job)):
+            self.bus.subscribe(channel, registry.instrument(
+                'bus_channel', fun, channel=channel))
+        self._stop.clear()
+        if self.rate:
+            self._thread = threading.Thread(target=self._readings_loop,
+                                            name='push-readings')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self.bus.log('Deleting push plugin')
+        self._stop.set()
+        with self._lock:
+            clients = list(self.clients.values())
+            self.clients.clear()
+        for client in clients:
+            client.close()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def subscribe_client(self):
+        """New client, which starts with the connection state."""
+        client = PushClient(next(self._ids), self.queue_size)
+        connected = self.bus.publish('serial-isconnected')
+        client.put('connection', 'connection',
+                   {'connected': bool(connected and connected[0])})
+        with self._lock:
+            self.clients[client.id] = client
+        return client
+
+    def unsubscribe_client(self, client):
+        with self._lock:
+            self.clients.pop(client.id, None)
+        client.close()
+
+    def publish(self, event, data, key=None):
+        with self._lock:
+            clients = list(self.clients.values())
+        for client in clients:
+            client.put(key or event, event, data)
+        registry.inc('push_events_total', event=event)
+
+    def publish_connection(self, connected):
+        self.publish('connection', {'connected': connected})
+
+    def publish_job(self, job):
+        self.publish('job', {'id': job.id, 'name': job.name,
+                             'state': job.state, 'progress': job.progress},
+                     key='job-{}'.format(job.id))
+
+    def _readings_loop(self):
+        period = 1 / self.rate
+        while not self._stop.is_set():
+            start = time.time()
+            if self.clients and self.bus.publish('serial-isconnected')[0]:
+                result = self.bus.publish('serial-write', ['vread', self.pins],
+                                          PRIORITY_BULK)[0]
+                # data is None when the read timed out
+                if result['success'] and result['data'] is not None:
+                    self.publish('readings', {'time': start, 'pins': self.pins,
+                                              'values': result['data']})
+            self._stop.wait(period - (time.time() - start))
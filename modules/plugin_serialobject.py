@@ -1,26 +1,123 @@
+import itertools
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
 from cherrypy.process import plugins
-from modules.serial_controller import Arduino
+from modules.metrics import registry
+from modules.serial_controller import Arduino, Deferred
 from serial import SerialException
 
+# Priorities of the I/O queue, lower values run first
+PRIORITY_CONTROL = 0    # connection management
+PRIORITY_INTERACTIVE = 1    # commands coming from the web interface
+PRIORITY_BULK = 2    # scripts, sweeps, characterizations and other long jobs
+# milis that the waits of a batch can add up to
+BATCH_WAIT_LIMIT = 1000
+
 
 class SerialObjectPlugin(plugins.SimplePlugin):
-    def __init__(self, portname, bus):
+    """Owner of the serial object.
+
+    Every access to the board goes through a single I/O thread fed by a
+    priority queue, so commands published from different server threads never
+    interleave on the wire, and interactive commands jump ahead of bulk work.
+
+    Args:
+        vset_rate (float): coalesced writes per second of `serial_vset`, 0 to
+            write every call as is
+    """
+    def __init__(self, portname, bus, vset_rate=50):
         plugins.SimplePlugin.__init__(self, bus)
         self.serial = Arduino(portname)
+        self.serial.io = self._io
+        self.vset_rate = vset_rate
+        self._queue = queue.PriorityQueue()
+        # tie breaker keeping FIFO order among equal priorities
+        self._counter = itertools.count()
+        self._thread = None
+        # values per pin waiting for the next coalesced vset, the futures of
+        # the calls waiting for it, and when the last one was written
+        self._vset_pending = {}
+        self._vset_waiters = []
+        self._vset_scheduled = False
+        self._vset_last = 0.0
+        self._vset_lock = threading.Lock()
+        registry.describe('serial_vset_superseded_total',
+                          'Coalesced vset values replaced before being written')
 
     def start(self):
         self.bus.log('Instantiating serial object plugin')
-        self.bus.subscribe("serial-connect", self.connect)
-        self.bus.subscribe("serial-disconnect", self.disconnect)
-        self.bus.subscribe("serial-isconnected", self.is_connected)
-        self.bus.subscribe("serial-write", self.serial_write)
-        self.bus.subscribe("serial-hiz-mode", self.serial_hiz_mode)
+        self._thread = threading.Thread(target=self._io_loop,
+                                        name='serial-io')
+        self._thread.daemon = True
+        self._thread.start()
+        for channel, fun in (("serial-connect", self.connect),
+                             ("serial-disconnect", self.disconnect),
+                             ("serial-isconnected", self.is_connected),
+                             ("serial-write", self.serial_write),
+                             ("serial-submit", self.serial_submit),
+                             ("serial-batch", self.serial_batch),
+                             ("serial-vset", self.serial_vset),
+                             ("serial-hiz-mode", self.serial_hiz_mode)):
+            self.bus.subscribe(channel, registry.instrument(
+                'bus_channel', fun, channel=channel))
 
     def stop(self):
         self.bus.log('Deleting serial object plugin')
         self.disconnect()
+        if self._thread:
+            # sentinel, runs after anything already queued
+            self._queue.put((PRIORITY_BULK + 1, next(self._counter), None))
+            self._thread.join()
+            self._thread = None
+
+    def _io_loop(self):
+        while True:
+            _, _, item = self._queue.get()
+            if item is None:
+                break
+            registry.inc('serial_queue_items_total')
+            future, fun, args = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = fun(*args)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def submit(self, fun, *args, priority=PRIORITY_INTERACTIVE):
+        """Schedule `fun(*args)` on the I/O thread.
+
+        Calls made from the I/O thread itself, or before the plugin is
+        started, run immediately to avoid waiting on themselves.
+
+        Returns:
+            concurrent.futures.Future
+        """
+        if self._thread is None or threading.current_thread() is self._thread:
+            future = Future()
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(fun(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        future = Future()
+        self._queue.put((priority, next(self._counter), (future, fun, args)))
+        return future
+
+    def _io(self, fun, *args):
+        # writes of the commands waiting for the board out of the I/O thread
+        return self.submit(fun, *args, priority=PRIORITY_INTERACTIVE).result()
 
     def connect(self):
+        return self.submit(self._connect, priority=PRIORITY_CONTROL).result()
+
+    def _connect(self):
         result = self.serial.connect()
         self.bus.log(result[1])
         if result[0]:
@@ -28,23 +125,230 @@ class SerialObjectPlugin(plugins.SimplePlugin):
         return result[0]
 
     def disconnect(self):
+        return self.submit(self._disconnect, priority=PRIORITY_CONTROL).result()
+
+    def _disconnect(self):
         result = self.serial.disconnect()
         self.bus.log(result[1])
+        if result[0]:
+            _ = self.bus.publish('serial-just-disconnected')
         return result[0]
 
     def is_connected(self):
         return self.serial.is_connected()
 
-    def serial_write(self, data):
+    def serial_write(self, data, priority=PRIORITY_INTERACTIVE):
+        """Run a command on the I/O thread and wait for its result.
+
+        Commands that wait for the board, such as vread, only write on the I/O
+        thread, and wait in the calling thread, see `Deferred`. So the I/O
+        thread goes on with other commands meanwhile, and several reads can be
+        in flight.
+        """
+        started = self.submit(self._serial_start, data, priority=priority)
+        return self._serial_finish(started.result())
+
+    def serial_submit(self, data, priority=PRIORITY_BULK):
+        """Queue a command without waiting for it.
+
+        Returns:
+            concurrent.futures.Future: resolves to the same dict returned by
+            `serial_write`
+        """
+        future = Future()
+        future.set_running_or_notify_cancel()
+
+        def started(start):
+            try:
+                result = start.result()
+            except Exception as e:
+                future.set_exception(e)
+                return
+            if not isinstance(result, Deferred):
+                future.set_result(result)
+                return
+            # wait for the board out of the I/O thread
+            thread = threading.Thread(
+                target=lambda: future.set_result(self._serial_finish(result)),
+                name='serial-wait')
+            thread.daemon = True
+            thread.start()
+
+        self.submit(self._serial_start, data,
+                    priority=priority).add_done_callback(started)
+        return future
+
+    def _serial_write(self, data):
+        """Run a command and wait for it in the current thread."""
+        return self._serial_finish(self._serial_start(data))
+
+    def _serial_start(self, data):
+        """Start a command, returning its result dict, or its `Deferred` if it
+        waits for the board.
+        """
         try:
             if len(data) > 1:
-                result = self.serial.serial_write(data[0], data[1:])
+                result = self.serial.start_command(data[0], data[1:])
             else:
-                result = self.serial.serial_write(data[0], [])
+                result = self.serial.start_command(data[0], [])
         except (ValueError, SerialException, AttributeError) as e:
-            self.bus.log('ERROR ' + str(e))
-            return {'success': False, 'data': None, 'info': str(e)}
+            return self._serial_failure(e)
+        if isinstance(result, Deferred):
+            return result
         return {'success': True, 'data': result, 'info': None}
 
+    def _serial_finish(self, result):
+        if not isinstance(result, Deferred):
+            return result
+        try:
+            data = result.wait()
+        except (ValueError, SerialException, AttributeError) as e:
+            return self._serial_failure(e)
+        return {'success': True, 'data': data, 'info': None}
+
+    def _serial_failure(self, e):
+        self.bus.log('ERROR ' + str(e))
+        registry.inc('serial_write_failures_total')
+        return {'success': False, 'data': None, 'info': str(e)}
+
+    def serial_batch(self, commands, stop_on_error=True,
+                     priority=PRIORITY_INTERACTIVE):
+        """Run a list of commands back to back on the I/O thread, as a single
+        queue item so that nothing else runs in between, and wait for them.
+
+        Args:
+            commands (list): commands in the format of `serial_write`, e.g.
+                ['vset', pins, values], plus ['wait', milis] to pause, up to
+                `BATCH_WAIT_LIMIT` in total
+            stop_on_error (bool): skip the commands after a failed one
+
+        Returns:
+            list of the result dicts of the commands run, as returned by
+            `serial_write`
+        """
+        return self.submit(self._serial_batch, commands, stop_on_error,
+                           priority=priority).result()
+
+    def _serial_batch(self, commands, stop_on_error):
+        results = []
+        # waits hold the I/O thread, so they are limited per batch
+        wait_left = BATCH_WAIT_LIMIT
+        for data in commands:
+            try:
+                if not isinstance(data, list) or not data:
+                    raise ValueError('Commands must be non empty lists')
+                if data[0] == 'wait':
+                    milis = float(data[1])
+                    if not 0 <= milis <= wait_left:
+                        raise ValueError(
+                            'Waits must add up to {} ms at most per '
+                            'batch'.format(BATCH_WAIT_LIMIT))
+                    wait_left -= milis
+                    time.sleep(milis / 1000)
+                    result = {'success': True, 'data': None, 'info': None}
+                else:
+                    result = self._serial_write(data)
+            except Exception as e:
+                # e.g. KeyError of a bad pin, the results of the commands run
+                # are kept
+                self.bus.log('ERROR ' + str(e))
+                registry.inc('serial_write_failures_total')
+                result = {'success': False, 'data': None,
+                          'info': '{}: {}'.format(type(e).__name__, e)}
+            results.append(result)
+            if stop_on_error and not result['success']:
+                break
+        return results
+
+    def serial_vset(self, pins, values):
+        """Set PWM values coalescing with other calls, for interactive
+        controls that send them faster than the board can follow.
+
+        Values wait for the next write, done at most `vset_rate` times per
+        second, and a newer value for a pin replaces the one waiting. So the
+        board gets the latest values with a bounded delay, however fast they
+        come.
+
+        Returns:
+            dict as returned by `serial_write`, with the values written for
+            `pins` as data {'pins', 'values'}, which are newer than the given
+            ones if they were superseded
+        """
+        # checked here, as one invalid value would fail the whole write of
+        # the values coalesced with it
+        error = self._check_vset(pins, values)
+        if error:
+            return {'success': False, 'data': None, 'info': error}
+        if not self.vset_rate:
+            result = self.serial_write(['vset', pins, values])
+            if result['success']:
+                result['data'] = {'pins': pins, 'values': values}
+            return result
+        future = Future()
+        delay = None
+        with self._vset_lock:
+            superseded = sum(pin in self._vset_pending for pin in pins)
+            if superseded:
+                registry.inc('serial_vset_superseded_total', superseded)
+            self._vset_pending.update(zip(pins, values))
+            self._vset_waiters.append(future)
+            if not self._vset_scheduled:
+                self._vset_scheduled = True
+                delay = self._vset_last + 1 / self.vset_rate - time.time()
+        # scheduled out of the lock, as the write takes it and runs inline
+        # when the I/O thread isn't running or this is the I/O thread
+        if delay is not None:
+            if delay > 0:
+                timer = threading.Timer(delay, self._schedule_vset)
+                timer.daemon = True
+                timer.start()
+            else:
+                self._schedule_vset()
+        result = future.result()
+        if not result['success']:
+            return result
+        written = result['data']
+        return {'success': True, 'info': None,
+                'data': {'pins': pins,
+                         'values': [written[pin] for pin in pins]}}
+
+    def _check_vset(self, pins, values):
+        """Error message for invalid vset arguments, or None."""
+        if not isinstance(pins, list) or not isinstance(values, list):
+            return 'Pins and values must be lists'
+        if len(pins) != len(values):
+            return 'There must be a value for each pin'
+        for pin in pins:
+            if pin not in self.serial.pwm_outputs:
+                return 'Invalid pin {}, must be one of {}'.format(
+                    pin, self.serial.pwm_outputs)
+        for value in values:
+            if isinstance(value, bool) or \
+                    not isinstance(value, (int, float)):
+                return 'Invalid value {}, must be a number'.format(value)
+        return None
+
+    def _schedule_vset(self):
+        self.submit(self._write_vset, priority=PRIORITY_INTERACTIVE)
+
+    def _write_vset(self):
+        with self._vset_lock:
+            pending, self._vset_pending = self._vset_pending, {}
+            waiters, self._vset_waiters = self._vset_waiters, []
+            self._vset_scheduled = False
+            self._vset_last = time.time()
+        try:
+            result = self._serial_write(['vset', list(pending),
+                                         list(pending.values())])
+        except Exception as e:
+            # the arguments were checked, so don't leave the callers waiting
+            # on anything unexpected
+            self.bus.log('ERROR ' + str(e))
+            result = {'success': False, 'data': None, 'info': str(e)}
+        if result['success']:
+            result = dict(result, data=pending)
+        for future in waiters:
+            future.set_result(result)
+
     def serial_hiz_mode(self, hiz):
         self.serial.hiz_mode = hiz
@@ -0,0 +1,82 @@
+import threading
+
+import numpy as np
+
+
+class RingBuffer(object):
+    """Fixed size buffer of timestamped samples.
+
+    Storage is preallocated on creation, so appending never allocates, and
+    once full the oldest samples are overwritten. Reads return arrays copied
+    only from the requested part of the buffer.
+    """
+    def __init__(self, size, dtype=np.float64):
+        """
+        Args:
+            size (int): maximum number of samples kept
+            dtype: numpy type of the sample values
+        """
+        self.size = size
+        self.times = np.zeros(size, dtype=np.float64)
+        self.values = np.zeros(size, dtype=dtype)
+        # total number of samples ever appended
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def append(self, timestamp, value):
+        with self._lock:
+            i = self.count % self.size
+            self.times[i] = timestamp
+            self.values[i] = value
+            self.count += 1
+
+    def clear(self):
+        with self._lock:
+            self.count = 0
+
+    def last(self, n=None):
+        """Get the last `n` samples, or all of them if `n` is not given.
+
+        Returns:
+            (times, values) arrays in chronological order
+        """
+        with self._lock:
+            length = min(self.count, self.size)
+            n = length if n is None else max(0, min(n, length))
+            return self._tail(n)
+
+    def since(self, t):
+        """Get the samples taken at or after the timestamp `t`.
+
+        Returns:
+            (times, values) arrays in chronological order
+        """
+        with self._lock:
+            if self.count <= self.size:
+                n = self.count - np.searchsorted(self.times[:self.count], t)
+            else:
+                # timestamps are sorted within each of the two contiguous
+                # halves of the ring, the older one starting at `end`
+                end = self.count % self.size
+                older, newer = self.times[end:], self.times[:end]
+                if end and t > older[-1]:
+                    n = end - np.searchsorted(newer, t)
+                else:
+                    n = len(older) - np.searchsorted(older, t) + end
+            return self._tail(int(n))
+
+    def _tail(self, n):
+        if self.count <= self.size:
+            sl = slice(self.count - n, self.count)
+            return self.times[sl].copy(), self.values[sl].copy()
+        end = self.count % self.size
+        if n <= end:
+            sl = slice(end - n, end)
+            return self.times[sl].copy(), self.values[sl].copy()
+        # the requested samples wrap around the end of the storage
+        first = slice(self.size - (n - end), self.size)
+        return (np.concatenate((self.times[first], self.times[:end])),
+                np.concatenate((self.values[first], self.values[:end])))
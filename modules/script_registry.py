@@ -0,0 +1,119 @@
+import importlib
+import inspect
+import os
+import threading
+
+
+class _Entry(object):
+    """A loaded script: its module, `AppScript` class, the signature of its
+    `run` without `self`, and the stamp of the file it was loaded from.
+    """
+    def __init__(self, module, stamp):
+        self.module = module
+        self.cls = module.AppScript
+        self.stamp = stamp
+        signature = inspect.signature(self.cls.run)
+        self.signature = signature.replace(
+            parameters=list(signature.parameters.values())[1:])
+        self.doc = inspect.cleandoc(self.cls.run.__doc__ or '')
+
+
+class ScriptRegistry(object):
+    """Cache of the scripts of the scripts folder, imported once and reloaded
+    only when their file changes, so that edited scripts are picked up without
+    restarting the server.
+
+    Args:
+        folder (str): folder of the scripts
+        package (str): package name of the folder
+    """
+    def __init__(self, folder='addons/scripts', package='addons.scripts'):
+        self.folder = folder
+        self.package = package
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _path(self, name):
+        return os.path.join(self.folder, name + '.py')
+
+    def _stamp(self, name):
+        try:
+            stat = os.stat(self._path(name))
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def names(self):
+        """Names of the scripts in the folder."""
+        return sorted(file[:-3] for file in os.listdir(self.folder)
+                      if file.endswith('.py') and file != '__init__.py')
+
+    def get(self, name):
+        """Entry of the script `name`, imported the first time and reloaded if
+        its file changed since.
+
+        Raises:
+            LookupError: if there is no such script
+            Exception: any error importing it, e.g. ImportError, SyntaxError,
+                or AttributeError if it doesn't define `AppScript`
+        """
+        stamp = self._stamp(name)
+        if stamp is None or name.startswith('_') or '.' in name:
+            raise LookupError('No script named {}'.format(name))
+        entry = self._entries.get(name)
+        if entry is not None and entry.stamp == stamp:
+            return entry
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry.stamp != stamp:
+                module_name = '.'.join([self.package, name])
+                if entry is None:
+                    module = importlib.import_module(module_name)
+                else:
+                    importlib.invalidate_caches()
+                    module = importlib.reload(entry.module)
+                entry = self._entries[name] = _Entry(module, stamp)
+        return entry
+
+    def create(self, name, cherry, kwargs):
+        """Instance of the script `name`, after checking that `kwargs` fit the
+        signature of its `run`.
+
+        Raises:
+            TypeError: if the kwargs don't fit
+            and the errors of `get`
+        """
+        entry = self.get(name)
+        entry.signature.bind(**kwargs)
+        return entry.cls(cherry)
+
+    def preload(self):
+        """Import all the scripts, so that their first run is fast.
+
+        Returns:
+            dict of the error of each script that failed
+        """
+        errors = {}
+        for name in self.names():
+            try:
+                self.get(name)
+            except Exception as exc:
+                errors[name] = '{}: {}'.format(type(exc).__name__, exc)
+        return errors
+
+    def describe(self):
+        """Name, `run` signature and docstring of every script, loading the
+        new and changed ones. Scripts that fail to load have an `error`.
+        """
+        scripts = []
+        for name in self.names():
+            try:
+                entry = self.get(name)
+            except Exception as exc:
+                scripts.append({'name': name, 'error': '{}: {}'.format(
+                    type(exc).__name__, exc)})
+            else:
+                scripts.append({'name': name,
+                                'signature': str(entry.signature),
+                                'doc': entry.doc})
+        return scripts
@@ -1,8 +1,113 @@
+import functools
+import numpy as np
 import pyfirmata
+import threading
 import time
+from serial import SerialException
+from modules.metrics import registry
+from modules.ringbuffer import RingBuffer
 
 REPORT_ANALOG_NOW_QUERY = 0x01    # SysEx command code to request an analog report once
 REPORT_ANALOG_NOW_RESPONSE = 0x02    # SysEx command code in response to the matching query
+SWEEP_CONFIG = 0x03    # SysEx command code to start a sweep on the board
+SWEEP_DATA = 0x04    # SysEx command code carrying output values of the sweep table
+SWEEP_STOP = 0x05    # SysEx command code to abort a sweep
+SWEEP_RESULT = 0x06    # SysEx command code reporting the readings of a sweep step
+PULSE_TRAIN = 0x07    # SysEx command code to start a pulse train on the switch pins
+PULSE_STOP = 0x08    # SysEx command code to abort a pulse train
+PULSE_DONE = 0x09    # SysEx command code reporting the end of a pulse train
+
+READ_TIMEOUT = 0.05    # seconds the reader thread blocks on the port before checking for a stop request
+VREAD_TIMEOUT = 0.1    # seconds to wait for a REPORT_ANALOG_NOW_RESPONSE
+ANALOG_READ_TIME = 0.00012    # seconds the board takes for each analogRead, added to the timeout when oversampling
+MAX_SAMPLES = 127    # oversampling count of a REPORT_ANALOG_NOW query
+MAX_TAGS = 128    # REPORT_ANALOG_NOW queries in flight, bounded by the 7-bit tag
+ACQUISITION_BUFFER_SIZE = 60000    # samples kept per pin, 10 minutes at the minimum sampling interval
+SWEEP_BUFFER_SIZE = 128    # output values the board can hold ahead of the running step
+SWEEP_CHUNK = 16    # output values per SWEEP_DATA message, bounded by the Firmata SysEx buffer
+SWEEP_MAX_STEPS = 16383
+PULSE_MAX_MICROS = 2**21 - 1    # longest pulse width or gap
+PULSE_MAX_COUNT = 16383
+PULSE_MODES = {'a': 0, 'b': 1, 'ab': 2}
+
+class _CountingSerial(object):
+    """Proxy of the serial object of the board, counting the bytes that go
+    through it into `counts`, a [read, written] list.
+    """
+    def __init__(self, sp, counts):
+        object.__setattr__(self, '_sp', sp)
+        object.__setattr__(self, '_counts', counts)
+
+    def read(self, size=1):
+        data = self._sp.read(size)
+        self._counts[0] += len(data)
+        return data
+
+    def write(self, data):
+        self._counts[1] += len(data)
+        return self._sp.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._sp, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._sp, name, value)
+
+
+class Deferred(object):
+    """Remainder of a command that waits for the board, returned by the
+    commands split so that only their writes hold the I/O thread of
+    `SerialObjectPlugin`. `wait` completes the command in the caller's thread
+    and returns its result.
+    """
+    def __init__(self, wait, *args):
+        self._wait = wait
+        self._args = args
+        self._callbacks = []
+
+    def add_done_callback(self, fun):
+        """Call `fun(failed)` once `wait` returns or raises."""
+        self._callbacks.append(fun)
+
+    def wait(self):
+        failed = True
+        try:
+            result = self._wait(*self._args)
+            failed = False
+            return result
+        finally:
+            for fun in self._callbacks:
+                fun(failed)
+
+
+def _timed_command(name, fun):
+    """Wrap the command `fun` to count its calls and errors and to observe
+    its latency as `arduino_command_*` metrics, up to the end of the wait of
+    the `Deferred` it returns, if any.
+    """
+    @functools.wraps(fun)
+    def wrapper(*args):
+        start = time.perf_counter()
+
+        def done(failed):
+            if failed:
+                registry.inc('arduino_command_errors_total', command=name)
+            registry.observe('arduino_command_seconds',
+                             time.perf_counter() - start, command=name)
+            registry.inc('arduino_command_total', command=name)
+
+        try:
+            result = fun(*args)
+        except Exception:
+            done(True)
+            raise
+        if isinstance(result, Deferred):
+            result.add_done_callback(done)
+        else:
+            done(False)
+        return result
+    return wrapper
+
 
 class Arduino:
 
@@ -18,6 +123,11 @@ class Arduino:
         self.board = None
         self.port = port
         self.iterthread = None
+        self._stop_reading = threading.Event()
+        # io(fun, *args) runs the writes of the commands completed by a
+        # `Deferred` on the thread owning the port, see `SerialObjectPlugin`.
+        # In place by default
+        self.io = lambda fun, *args: fun(*args)
         self.hiz_mode = hiz_mode
         self.analog_inputs = (0,1,2,3,4,5)
         self.pwm_outputs = (3,9,10,11)
@@ -25,11 +135,39 @@ class Arduino:
         self.hiz_pins = {3:7, 9:8, 10:12, 11:13}
         self.sw_pins = (2,4,5,6)
         self._sw_state = None
+        # shadow copy of the output state. keys: pins, values: last value sent
+        self._outputs = {}
         self.commands = {
             'vset': {'fun': self._vset},
-            'vread': {'fun': self._vread},
-            'sw_control': {'fun': self._sw_control}}
-        self._vread_done = False
+            'vread': {'fun': self._vread_query},
+            'vread_multi': {'fun': self._vread_multi_query},
+            'sw_control': {'fun': self._sw_control},
+            'sweep': {'fun': self._sweep},
+            'pulse_train': {'fun': self._pulse_train_start},
+            'pulse_stop': {'fun': self._pulse_stop_start},
+            'acquire': {'fun': self._acquire},
+            'acquire_stop': {'fun': self.stop_acquisition},
+            'samples': {'fun': self._samples}}
+        for name, command in self.commands.items():
+            command['fun'] = _timed_command(name, command['fun'])
+        # bytes [read, written] through the serial port
+        self._bytes = [0, 0]
+        registry.add_collector(self._collect_metrics)
+        registry.describe('arduino_vread_timeouts_total',
+                          'Analog reads not answered by the board in time')
+        # keys: analog pins being acquired, values: their RingBuffer
+        self.buffers = {}
+        # state of the running on-board sweep, see `sweep`
+        self._sweep_state = None
+        self._sweep_cond = threading.Condition()
+        # set when the running pulse train ends, see `pulse_train`
+        self._pulses_done = threading.Event()
+        self._pulses_done.set()
+        self.pulses_count = 0
+        # pending REPORT_ANALOG_NOW queries. keys: tags, values: [event, values, timeout]
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._next_tag = 0
 
     def __del__(self):
         self.disconnect()
@@ -44,8 +182,12 @@ class Arduino:
         try:
             board = None
             board = pyfirmata.Arduino(self.port)
+            board.sp = _CountingSerial(board.sp, self._bytes)
 
             board.add_cmd_handler(REPORT_ANALOG_NOW_RESPONSE, self._handle_report_analog_now)
+            board.add_cmd_handler(pyfirmata.ANALOG_MESSAGE, self._handle_analog_message)
+            board.add_cmd_handler(SWEEP_RESULT, self._handle_sweep_result)
+            board.add_cmd_handler(PULSE_DONE, self._handle_pulse_done)
         except Exception as e:
             if board:
                 board.exit()
@@ -59,7 +201,7 @@ class Arduino:
                 # all outputs on HI-Z
                 self._sw_control('hiz')
             # HI-Z pins init
-            for pin in self.hiz_pins:
+            for pin in self.hiz_pins.values():
                 board.digital[pin].mode = pyfirmata.OUTPUT
                 # all outputs on HI-Z if the mode is enabled, and viceversa
                 state = 1 if self.hiz_mode else 0
@@ -69,6 +211,10 @@ class Arduino:
                 board.digital[i].mode = pyfirmata.PWM
                 board.digital[i].write(0.0)
             self.board = board
+            self._outputs = {pin: board.digital[pin].value
+                             for pin in self.sw_pins + tuple(self.hiz_pins.values()) +
+                             self.pwm_outputs}
+            self._start_reader()
             return True, 'Serial object connection successful'
 
     def disconnect(self):
@@ -78,13 +224,58 @@ class Arduino:
         if self.board:
             # send a reset command
             self.reset()
+            self._stop_reader()
             self.board.exit()
             self.board = None
             self.iterthread = None
+            self.buffers = {}
             return True, 'Serial object disconnection successful'
         else:
             return False, 'Serial object already disconnected'
 
+    def _start_reader(self):
+        """Start the thread that owns the reading side of the port.
+
+        The serial timeout is lowered so that `board.iterate()` blocks on the
+        port instead of returning immediately, which makes every incoming
+        message get parsed as soon as it arrives without any polling.
+        """
+        self.board.sp.timeout = READ_TIMEOUT
+        self._stop_reading.clear()
+        it = threading.Thread(target=self._read_loop,
+                              args=(self.board, self._stop_reading),
+                              name='arduino-reader')
+        it.daemon = True  # stop the thread if main program quits
+        it.start()
+        self.iterthread = it
+
+    def _stop_reader(self):
+        self._stop_reading.set()
+        if self.iterthread and self.iterthread is not threading.current_thread():
+            self.iterthread.join(READ_TIMEOUT * 4)
+        self.iterthread = None
+
+    @staticmethod
+    def _read_loop(board, stop):
+        """Reader thread body. Dispatches every message received from the
+        board to its handler until `stop` is set or the port goes away.
+        """
+        while not stop.is_set():
+            try:
+                board.iterate()
+            except (SerialException, OSError, ValueError):
+                # port closed or device unplugged
+                break
+            except TypeError:
+                # a read timed out in the middle of a message; the rest of
+                # it will be discarded as unknown bytes
+                continue
+
+    def _collect_metrics(self):
+        labels = {'port': self.port}
+        return [('serial_bytes_read_total', labels, self._bytes[0]),
+                ('serial_bytes_written_total', labels, self._bytes[1])]
+
     def reconnect(self):
         _ = self.disconnect()
         return self.connect()
@@ -104,6 +295,15 @@ class Arduino:
         Returns:
             None or any value read, depending on the requested command.
         """
+        result = self.start_command(cmd, params)
+        if isinstance(result, Deferred):
+            result = result.wait()
+        return result
+
+    def start_command(self, cmd=None, params=None):
+        """Like `serial_write`, but commands that wait for the board return
+        after writing, with a `Deferred` to wait for their result.
+        """
         if cmd not in self.commands:
             raise ValueError('Unexpected command: {}'.format(cmd))
 
@@ -123,97 +323,299 @@ class Arduino:
     def _vset(self, pins, values, zero_is_hiz=False):
         """Quickly send PWM values to the board.
 
+        All the HI-Z control and PWM pins are written in a single burst, see
+        `_write_outputs`.
+
         Args:
             pins (int list): any combination of (3,9,10,11)
             values (float list): in the range 0..1, corresponding to the pins list
             zero_is_hiz (bool): whether to treat a zero value as HI-Z output. If `hiz_mode` is `True`, this arg has no effect
         """
+        hiz_values = {}
+        pwm_values = {}
         for pin, value in zip(pins, values):
             # get the HI-Z controller pin corresponding to the current PWM pin
             hizpin = self.hiz_pins[pin]
             # set digital pin controlling hf4066 IC switch accordingly
             if (zero_is_hiz or self.hiz_mode) and value == 0.0:
-                self.board.digital[hizpin].write(1)
+                hiz_values[hizpin] = 1
             else:
-                self.board.digital[hizpin].write(0)
-            self.board.digital[pin].write(value)
+                hiz_values[hizpin] = 0
+            pwm_values[pin] = value
+        self._write_outputs(hiz_values, pwm_values)
 
-    def _vread(self, pins):
+    def _write_outputs(self, digital=None, pwm=None):
+        """Write output pins, sending only those whose value changed.
+
+        Digital pins are packed into one DIGITAL_MESSAGE per port, and all
+        the messages go out in a single write, digital ports first, so that
+        pins meant to switch together do so with the least possible skew.
+
+        Args:
+            digital (dict): keys: digital output pins, values: 0 or 1
+            pwm (dict): keys: PWM pins, values: in the range 0..1
+        """
+        msg = bytearray()
+        ports = set()
+        for pin, value in (digital or {}).items():
+            if self._outputs.get(pin) == value:
+                continue
+            self._outputs[pin] = value
+            # keep pyFirmata's view of the pin in sync, it is used for the mask
+            self.board.digital[pin].value = value
+            ports.add(self.board.digital[pin].port)
+        for port in sorted(ports, key=lambda port: port.port_number):
+            mask = 0
+            for pin in port.pins:
+                if pin.mode == pyfirmata.OUTPUT and pin.value == 1:
+                    mask |= 1 << (pin.pin_number - port.port_number * 8)
+            msg.extend((pyfirmata.DIGITAL_MESSAGE + port.port_number,
+                        mask % 128, mask >> 7))
+        for pin, value in (pwm or {}).items():
+            if self._outputs.get(pin) == value:
+                continue
+            self._outputs[pin] = value
+            self.board.digital[pin].value = value
+            duty = int(round(value * 255))
+            msg.extend((pyfirmata.ANALOG_MESSAGE + pin, duty % 128, duty >> 7))
+        if msg:
+            self.board.sp.write(msg)
+
+    def _vread(self, pins, samples=1):
         """Conveniently read analog values from the board.
 
-        This function is much more robust than having to rely on the utility
-        thread that periodically runs board.iterate(), since an analog read I/O
-        message does not signal it's completion, and therefore in cases where
-        there is a high load on the CPU or the serial connection, the usual
-        waiting time for the values to refresh might not be sufficient. However,
-        with a shared counter `_vread_count` and a custom SysEx command with its
-        corresponding handling function `_handle_report_analog_now`, the
-        update of the values can be tracked and hence the successful execution
-        of the command. This way meaningful analog values that truly represent
-        reality at the current state are ensured.
+        This function is much more robust than having to rely on the periodic
+        analog reports, since an analog read I/O message does not signal it's
+        completion, and therefore in cases where there is a high load on the
+        CPU or the serial connection, the usual waiting time for the values to
+        refresh might not be sufficient. However, with a custom SysEx command
+        and its corresponding handling function `_handle_report_analog_now`,
+        which runs on the reader thread and wakes up the caller waiting on the
+        matching tag, the update of the values can be tracked and hence the
+        successful execution of the command. This way meaningful analog values
+        that truly represent reality at the current state are ensured, and
+        they are returned as soon as the response is parsed.
+
+        With `samples` greater than 1, the board takes that many readings of
+        each pin and reports their statistics in the same response.
 
         Args:
             pins (int list): any combination of (0,1,2,3,4,5)
+            samples (int): readings to take of each pin, up to 127
         Returns:
-            None or float list: values in the range 0..1, corresponding to the
-            pin list, or None if the update wasn't received before 0.1s
+            None or list: values in the range 0..1, corresponding to the
+            pin list, or None if the update wasn't received before 0.1s (plus
+            the time taken by the readings). With more than one sample, each
+            value is a [mean, min, max] list
         """
-        result = []
-        self._vread_done = False
+        return self._vread_query(pins, samples).wait()
+
+    def _vread_query(self, pins, samples=1):
+        """Send a read, see `_vread`.
+
+        Returns:
+            Deferred: waits for the values
+        """
+        tag = self._vread_send(pins, samples)
+        return Deferred(self._vread_wait, tag, pins)
+
+    def _vread_multi(self, pin_lists, samples=1):
+        """Pipelined version of `_vread`.
+
+        All the queries are sent before waiting for any response, so the
+        serial round trip is paid once instead of once per query.
+
+        Args:
+            pin_lists (list of int lists): pins for each of the reads
+            samples (int): readings to take of each pin, see `_vread`
+        Returns:
+            list with the result of each read, as returned by `_vread`
+        """
+        return self._vread_multi_query(pin_lists, samples).wait()
+
+    def _vread_multi_query(self, pin_lists, samples=1):
+        """Send several reads, see `_vread_multi`.
+
+        Returns:
+            Deferred: waits for the values of all of them
+        """
+        tags = [self._vread_send(pins, samples) for pins in pin_lists]
+        return Deferred(self._vread_wait_all, tags, pin_lists)
+
+    def _vread_wait_all(self, tags, pin_lists):
+        return [self._vread_wait(tag, pins)
+                for tag, pins in zip(tags, pin_lists)]
+
+    def _vread_send(self, pins, samples=1):
+        """Register a pending read and send its tagged query.
+
+        Returns:
+            int: tag identifying the query
+        """
+        samples = int(samples)
+        if not 1 <= samples <= MAX_SAMPLES:
+            raise ValueError('Samples must be in the range 1..{}'.format(
+                MAX_SAMPLES))
         bwpins = 0
         for pin in pins:
             bwpins |= 1 << pin
-        self.board.send_sysex(REPORT_ANALOG_NOW_QUERY, bytes((bwpins,)))
-        status = 0
-        before = time.time()
-        while time.time() - before < 0.1:
-            time.sleep(0.001)
-            if not self.iterthread:
-                self.board.iterate()
-            if self._vread_done:
-                status = 1
-                break
-        if status == 0:
+        timeout = VREAD_TIMEOUT
+        if samples > 1:
+            timeout += samples * len(pins) * ANALOG_READ_TIME
+        with self._pending_lock:
+            if len(self._pending) >= MAX_TAGS:
+                raise ValueError('Too many analog reads in flight')
+            tag = self._next_tag
+            while tag in self._pending:
+                tag = (tag + 1) % MAX_TAGS
+            self._next_tag = (tag + 1) % MAX_TAGS
+            self._pending[tag] = [threading.Event(), None, timeout]
+        try:
+            self.board.send_sysex(REPORT_ANALOG_NOW_QUERY,
+                                  bytes((bwpins, tag, samples)))
+        except Exception:
+            with self._pending_lock:
+                del self._pending[tag]
+            raise
+        return tag
+
+    def _vread_wait(self, tag, pins):
+        """Wait for the response to a query sent with `_vread_send`.
+
+        Returns:
+            None or list: see `_vread`
+        """
+        event, _, timeout = self._pending[tag]
+        received = event.wait(timeout)
+        with self._pending_lock:
+            _, values, _ = self._pending.pop(tag)
+        if not received:
+            registry.inc('arduino_vread_timeouts_total')
             return None
-        for pin in pins:
-            result.append(self.board.analog[pin].read())
-        return result
+        return [values.get(pin) for pin in pins]
 
     def _handle_report_analog_now(self, *args, **kwargs):
         """Handler for our custom SysEx message, to be registered in the
         pyFirmata object `self.board`.
 
-        This method accesses the `value` attribute somewhere inside
+        The first byte is the tag of the query and the second one the number
+        of samples per pin. They are followed by (pin, lsb, msb) triplets for a
+        single sample, or by the pin, the sum (3 bytes), min and max (2 bytes
+        each) otherwise. Responses to queries that already timed out are
+        dropped.
+
+        This method also updates the `value` attribute somewhere inside
         `self.board`, which is not too neat. However this avoids having to
         subclass or fork the library in order to implement this functionality.
         """
-        for i in range(0, len(args), 3):
-            pin, lsb, msb = args[i], args[i+1], args[i+2]
-            value = round(float((msb << 7) + lsb) / 1023, 4)
-            self.board.analog[pin].value = value
-        self._vread_done = True
+        if len(args) < 2:
+            return
+        tag, samples = args[0], args[1]
+        values = {}
+        if samples <= 1:
+            for i in range(2, len(args) - 2, 3):
+                pin, lsb, msb = args[i], args[i+1], args[i+2]
+                value = round(float((msb << 7) + lsb) / 1023, 4)
+                self.board.analog[pin].value = value
+                values[pin] = value
+        else:
+            for i in range(2, len(args) - 7, 8):
+                pin = args[i]
+                total = args[i+1] + (args[i+2] << 7) + (args[i+3] << 14)
+                low = args[i+4] + (args[i+5] << 7)
+                high = args[i+6] + (args[i+7] << 7)
+                mean = round(float(total) / samples / 1023, 4)
+                self.board.analog[pin].value = mean
+                values[pin] = [mean, round(float(low) / 1023, 4),
+                               round(float(high) / 1023, 4)]
+        with self._pending_lock:
+            request = self._pending.get(tag)
+            if request is None:
+                return
+            request[1] = values
+        request[0].set()
+
+    def _handle_analog_message(self, pin_nr, lsb, msb):
+        """Handler for the periodic analog reports, replacing the one in the
+        pyFirmata object `self.board` so that the samples of the acquired
+        pins are kept along their host timestamp.
+        """
+        value = round(float((msb << 7) + lsb) / 1023, 4)
+        try:
+            if self.board.analog[pin_nr].reporting:
+                self.board.analog[pin_nr].value = value
+        except IndexError:
+            raise ValueError
+        buffer = self.buffers.get(pin_nr)
+        if buffer is not None:
+            buffer.append(time.time(), value)
 
     def enable_reporting(self, sampling=1000):
-        """Enable reporting of all the analog pins."""
-        # start reader thread to catch reported values
-        # the thread only stops when the serial connection is closed
-        it = pyfirmata.util.Iterator(self.board)
-        it.start()
-        it.daemonic = True  # stop the thread if main program quits
-        self.iterthread = it
+        """Enable reporting of all the analog pins.
 
+        Reported values are caught by the reader thread started on connection.
+        """
         for pin in self.analog_inputs:
             self.board.analog[pin].enable_reporting()
 
         self.sampling_interval(sampling)
 
+    def start_acquisition(self, pins, sampling=10,
+                          buffer_size=ACQUISITION_BUFFER_SIZE):
+        """Start recording every reported sample of `pins`.
+
+        Each pin gets its own `RingBuffer`, so memory use is fixed by
+        `buffer_size` regardless of how long the acquisition runs.
+
+        Args:
+            pins (int list): any combination of (0,1,2,3,4,5)
+            sampling (int): reporting interval in milis
+            buffer_size (int): samples kept per pin
+        """
+        for pin in pins:
+            self.buffers[pin] = RingBuffer(buffer_size)
+            self.board.analog[pin].enable_reporting()
+        self.sampling_interval(sampling)
+
+    def stop_acquisition(self, pins=None):
+        """Stop reporting `pins`, or all the acquired pins if not given. The
+        recorded samples stay available until the next acquisition.
+        """
+        for pin in (self.buffers if pins is None else pins):
+            self.board.analog[pin].disable_reporting()
+
+    def samples(self, pin, n=None, since=None):
+        """Get the recorded samples of `pin`, either the last `n` or those
+        taken since the timestamp `since`, or all of them if none is given.
+
+        Returns:
+            (times, values) numpy arrays in chronological order
+        """
+        buffer = self.buffers[pin]
+        if since is not None:
+            return buffer.since(since)
+        return buffer.last(n)
+
+    def _acquire(self, pins, sampling=10, buffer_size=ACQUISITION_BUFFER_SIZE):
+        self.start_acquisition(pins, sampling, buffer_size)
+
+    def _samples(self, pins, n=None, since=None):
+        """JSON friendly version of `samples`.
+
+        Returns:
+            list of [times, values] lists, corresponding to the pin list
+        """
+        result = []
+        for pin in pins:
+            times, values = self.samples(pin, n, since)
+            result.append([times.tolist(), values.tolist()])
+        return result
+
     def _vsweep(self, out_pins, in_pins, out_values, settling):
-        """Perform a sweep of voltages.
+        """Perform a sweep of voltages timed by the host.
 
         WARNING: It is quite blocking due to the settling waiting time and the
-        possibly long loop.
-
-        TODO: find a better implementation to avoid blocking the server.
+        possibly long loop. Prefer `sweep`, which runs on the board.
 
         Args:
             out_pins (int list): example: (3,9)
@@ -226,10 +628,9 @@ class Arduino:
         """
         results = []
         # iterate over the values, zipping them for convenience
-        for vals in zip(out_values):
-            # write the values to the board one pin at a time
-            for i, pin in enumerate(out_pins):
-                self.board.digital[pin].write(vals[i])
+        for vals in zip(*out_values):
+            # write the values of all the pins in one go
+            self._write_outputs(pwm=dict(zip(out_pins, vals)))
             # wait for settling time after all pins are written
             time.sleep(settling/1000)
             # collect the readings of the current step
@@ -238,6 +639,251 @@ class Arduino:
             results.append(step)
         return results
 
+    def sweep(self, out_pins, in_pins, out_values, settling):
+        """Perform a sweep of voltages on the board.
+
+        The table of output values is streamed to the board, which applies
+        each step, waits for the settling time with its own timer and reports
+        the readings back. Values are sent ahead of the running step as long as
+        they fit in the table of the board, so no step waits for a round trip.
+
+        The HI-Z control pins of `out_pins` are cleared before starting.
+
+        Args:
+            out_pins (int list): example: (3,9)
+            in_pins (int list): pins to read from. Example: (0,1)
+            out_values (list of float lists): float list for each out_pin, in the range 0..1. Example: ((0.0, 0.5, 1.0), (0.1, 0.2, 0.3))
+            settling (int): milis to wait, up to 16383
+
+        Returns:
+            numpy array with one row per step and one column per in_pin,
+            values in the range 0..1, or NaN for steps not reported in time
+        """
+        return self._sweep_start(out_pins, in_pins, out_values,
+                                 settling).wait()
+
+    def _sweep_start(self, out_pins, in_pins, out_values, settling):
+        """Check the arguments of `sweep`, start it on the board and send the
+        first values of the table.
+
+        Returns:
+            Deferred: streams the rest of the table and waits for the results,
+            writing through `io`
+        """
+        if not out_pins:
+            raise ValueError('No sweep output pins')
+        if len(out_values) != len(out_pins):
+            raise ValueError('There must be a value list for each sweep '
+                             'output pin')
+        if len(set(len(values) for values in out_values)) > 1:
+            raise ValueError('The value lists of a sweep must be of the same '
+                             'length')
+        steps = list(zip(*out_values))
+        nsteps = len(steps)
+        if nsteps > SWEEP_MAX_STEPS:
+            raise ValueError('Too many sweep steps: {}'.format(nsteps))
+        # values are sent as bytes of the PWM duty cycle
+        if not all(isinstance(value, (int, float)) and 0 <= value <= 1
+                   for vals in steps for value in vals):
+            raise ValueError('Sweep values must be in the range 0..1')
+        settling = int(settling)
+        # sent as two 7 bit bytes
+        if not 0 <= settling <= 16383:
+            raise ValueError('Invalid sweep settling: {}'.format(settling))
+        bwpins = 0
+        for pin in in_pins:
+            bwpins |= 1 << pin
+        # the board reports the pins in ascending order
+        reported = sorted(set(in_pins))
+        columns = [reported.index(pin) for pin in in_pins]
+        results = np.full((nsteps, len(reported)), np.nan)
+        with self._sweep_cond:
+            if self._sweep_state is not None:
+                raise ValueError('A sweep is already running')
+            self._sweep_state = {'results': results, 'done': 0}
+        try:
+            self._write_outputs({self.hiz_pins[pin]: 0 for pin in out_pins})
+            self.board.send_sysex(SWEEP_CONFIG, bytes((
+                settling % 128, settling >> 7, nsteps % 128, nsteps >> 7,
+                bwpins) + tuple(out_pins)))
+            window = SWEEP_BUFFER_SIZE // len(out_pins)
+            per_chunk = max(1, SWEEP_CHUNK // len(out_pins))
+            sent = 0
+            while sent < min(window, nsteps):
+                count = min(per_chunk, window - sent, nsteps - sent)
+                self._sweep_send(steps[sent:sent+count])
+                sent += count
+        except Exception:
+            with self._sweep_cond:
+                self._sweep_state = None
+            raise
+        return Deferred(self._sweep_wait, out_pins, steps, settling, sent,
+                        columns)
+
+    def _sweep_send(self, steps):
+        data = bytearray()
+        for vals in steps:
+            for value in vals:
+                duty = int(round(value * 255))
+                data.extend((duty % 128, duty >> 7))
+        self.board.send_sysex(SWEEP_DATA, data)
+
+    def _sweep_wait(self, out_pins, steps, settling, sent, columns):
+        """Flow control and results of a sweep started by `_sweep_start`.
+        Runs out of the I/O thread, so the board is written through `io`.
+        """
+        nsteps = len(steps)
+        window = SWEEP_BUFFER_SIZE // len(out_pins)
+        per_chunk = max(1, SWEEP_CHUNK // len(out_pins))
+        # give up when the board stops reporting for much longer than a step
+        timeout = settling / 1000 + 1.0
+        results = self._sweep_state['results']
+        try:
+            while True:
+                with self._sweep_cond:
+                    done = self._sweep_state['done']
+                    if done >= nsteps:
+                        break
+                    if sent - done >= window or sent == nsteps:
+                        if not self._sweep_cond.wait(timeout):
+                            if self._sweep_state['done'] == done:
+                                registry.inc('arduino_sweep_timeouts_total')
+                                self.io(self.board.send_sysex, SWEEP_STOP,
+                                        bytes())
+                                break
+                        continue
+                    count = min(per_chunk, window - (sent - done), nsteps - sent)
+                self.io(self._sweep_send, steps[sent:sent+count])
+                sent += count
+        finally:
+            with self._sweep_cond:
+                done = self._sweep_state['done']
+            self.io(self._sweep_end, out_pins, steps, done)
+        return results[:, columns]
+
+    def _sweep_end(self, out_pins, steps, done):
+        with self._sweep_cond:
+            self._sweep_state = None
+        # keep the shadow output state in line with the last step applied
+        if done:
+            for pin, value in zip(out_pins, steps[done - 1]):
+                self._outputs[pin] = value
+                self.board.digital[pin].value = value
+
+    def _sweep(self, out_pins, in_pins, out_values, settling):
+        """JSON friendly version of `sweep`.
+
+        Returns:
+            Deferred: waits for [step1:[p1 p2 ...], step2:[p1 p2 ...], ...]
+            like `_vsweep`, with None for the steps not reported in time
+        """
+        return Deferred(self._sweep_json, self._sweep_start(
+            out_pins, in_pins, out_values, settling))
+
+    @staticmethod
+    def _sweep_json(deferred):
+        return [None if np.isnan(step).any() else step.tolist()
+                for step in deferred.wait()]
+
+    def _handle_sweep_result(self, *args, **kwargs):
+        """Handler for the readings of a sweep step, to be registered in the
+        pyFirmata object `self.board`. The first two bytes are the step index,
+        followed by (lsb, msb) pairs for each input pin in ascending order.
+        """
+        if len(args) < 2:
+            return
+        step = args[0] + (args[1] << 7)
+        values = [round(float((args[i+1] << 7) + args[i]) / 1023, 4)
+                  for i in range(2, len(args) - 1, 2)]
+        with self._sweep_cond:
+            state = self._sweep_state
+            if state is None or step >= len(state['results']):
+                return
+            state['results'][step, :len(values)] = values
+            state['done'] += 1
+            self._sweep_cond.notify_all()
+
+    def pulse_train(self, mode, width, gap=0.0, count=1, wait=False):
+        """Output pulses on the switch pins, timed by the board.
+
+        Each pulse sets state 'a' or 'b' (see `_sw_control`) for `width`,
+        then HI-Z for `gap`. The pins are left at HI-Z when the train ends or
+        is stopped with `pulse_stop`.
+
+        Args:
+            mode (str): 'a', 'b', or 'ab' to alternate between both
+            width (float): pulse width in seconds, with microsecond resolution
+            gap (float): seconds at HI-Z between pulses
+            count (int): number of pulses, or 0 to run until stopped
+            wait (bool): whether to wait for the train to end. Ignored if
+                `count` is 0
+        Returns:
+            None or int: number of pulses done if waited for
+        """
+        result = self._pulse_train_start(mode, width, gap, count, wait)
+        if isinstance(result, Deferred):
+            result = result.wait()
+        return result
+
+    def _pulse_train_start(self, mode, width, gap=0.0, count=1, wait=False):
+        """Start a pulse train, see `pulse_train`.
+
+        Returns:
+            None, or a Deferred waiting for the end of the train if `wait`
+        """
+        width_us = int(round(width * 1e6))
+        gap_us = int(round(gap * 1e6))
+        if width_us <= 0:
+            raise ValueError('Pulse width must be at least 1 us, got {} s'.format(
+                width))
+        if width_us > PULSE_MAX_MICROS or not 0 <= gap_us <= PULSE_MAX_MICROS:
+            raise ValueError('Pulse width and gap must be below {} s'.format(
+                PULSE_MAX_MICROS / 1e6))
+        if mode not in PULSE_MODES:
+            raise ValueError('Unexpected pulse mode: {}'.format(mode))
+        count = int(count)
+        if not 0 <= count <= PULSE_MAX_COUNT:
+            raise ValueError('Too many pulses: {}'.format(count))
+        self._pulses_done.clear()
+        self.board.send_sysex(PULSE_TRAIN, bytes(
+            tuple(self.sw_pins) + (PULSE_MODES[mode],
+            width_us & 0x7F, (width_us >> 7) & 0x7F, width_us >> 14,
+            gap_us & 0x7F, (gap_us >> 7) & 0x7F, gap_us >> 14,
+            count % 128, count >> 7)))
+        # the board leaves the switches at HI-Z
+        for pin in self.sw_pins:
+            self._outputs[pin] = 0
+            self.board.digital[pin].value = 0
+        if wait and count:
+            return Deferred(self._pulses_wait,
+                            count * (width + gap) + VREAD_TIMEOUT)
+        return None
+
+    def pulse_stop(self):
+        """Stop the running pulse train, if any.
+
+        Returns:
+            None or int: number of pulses done, if the board confirmed it
+        """
+        return self._pulse_stop_start().wait()
+
+    def _pulse_stop_start(self):
+        self.board.send_sysex(PULSE_STOP, bytes())
+        return Deferred(self._pulses_wait, VREAD_TIMEOUT)
+
+    def _pulses_wait(self, timeout):
+        if self._pulses_done.wait(timeout):
+            return self.pulses_count
+        return None
+
+    def _handle_pulse_done(self, *args, **kwargs):
+        """Handler for the end of a pulse train, to be registered in the
+        pyFirmata object `self.board`.
+        """
+        if len(args) > 1:
+            self.pulses_count = args[0] + (args[1] << 7)
+        self._pulses_done.set()
+
     def _sw_control(self, cmd, duration=0.0):
         """Function controlling the switch actions.
 
@@ -260,28 +906,29 @@ class Arduino:
             'pulse_a': sets state 'a' for `duration`, then sets 'hiz'
             'pulse_b': sets state 'b' for `duration`, then sets 'hiz'
 
+        Pulses are timed by the board, see `pulse_train`.
+
         Args:
             cmd (str): selected command
-            duration (float): pulse width in miliseconds
+            duration (float): pulse width in seconds, required by the pulse
+                commands
+        Returns:
+            None, or for the pulse commands a Deferred waiting for the pulse
+            to end
         """
         def write_pins(vals):
-            for i, pin in enumerate(self.sw_pins):
-                self.board.digital[pin].write(vals[i])
+            self._write_outputs(dict(zip(self.sw_pins, vals)))
 
         if cmd == 'a':
             write_pins((1,0,0,1))
             self._sw_state = 'a'
         elif cmd == 'pulse_a':
-            write_pins((1,0,0,1))
-            time.sleep(duration)
-            write_pins((0,0,0,0))
+            return self._pulse_train_start('a', duration, wait=True)
         elif cmd == 'b':
             write_pins((0,1,1,0))
             self._sw_state = 'b'
         elif cmd == 'pulse_b':
-            write_pins((0,1,1,0))
-            time.sleep(duration)
-            write_pins((0,0,0,0))
+            return self._pulse_train_start('b', duration, wait=True)
         elif cmd == 'v+':
             write_pins((1,0,1,0))
         elif cmd == '0':
@@ -397,10 +397,69 @@ $(document).ready(function(){
       appendToCmdHistory(result, cmd['fname'], '{"cmd":"script","input":'+text+'}');
       if(result['success'] === true) {
         appendToScriptHistory(text);
+        waitForJob(result['data']['job'], function(status) {
+          if(status['state'] === 'done') {
+            flashMessage('Script '+cmd['fname']+' finished', 'success');
+          } else {
+            flashMessage('Script '+cmd['fname']+' '+status['state']+
+              (status['info'] ? ': '+status['info'] : ''), 'error');
+          }
+        });
       }
     });
   });
 
+  function isFinished(state) {
+    return ['done', 'failed', 'cancelled'].indexOf(state) !== -1;
+  }
+
+  // events pushed by the server: connection state, analog readings and job
+  // updates. Without EventSource support, jobs are polled instead
+  var jobCallbacks = {};
+  // jobs seen finishing, in case it happens before waitForJob listens
+  var finishedJobs = {};
+  var events = window.EventSource ? new EventSource("/events") : null;
+  if(events) {
+    events.addEventListener("connection", function(e) {
+      var data = JSON.parse(e.data);
+      connStateText.text(data['connected'] ? "Connected" : "Disconnected");
+    });
+    events.addEventListener("readings", function(e) {
+      var data = JSON.parse(e.data);
+      if(!data['values']) return;
+      for(var i = 0; i < data['pins'].length; i++) {
+        $(".vread-value").eq(data['pins'][i]).text(data['values'][i]);
+      }
+    });
+    events.addEventListener("job", function(e) {
+      var data = JSON.parse(e.data);
+      if(!isFinished(data['state'])) return;
+      finishedJobs[data['id']] = true;
+      if(data['id'] in jobCallbacks) {
+        var callback = jobCallbacks[data['id']];
+        delete jobCallbacks[data['id']];
+        $.get("/jobStatus", {job:data['id']}).done(function(res) {
+          callback(res['data']);
+        });
+      }
+    });
+  }
+
+  // wait until a background job finishes
+  function waitForJob(job, callback) {
+    $.get("/jobStatus", {job:job}).done(function(res) {
+      var status = res['data'];
+      if(status === null) return;
+      if(isFinished(status['state'])) {
+        callback(status);
+      } else if(events && !(job in finishedJobs)) {
+        jobCallbacks[job] = callback;
+      } else {
+        setTimeout(function() {waitForJob(job, callback);}, 1000);
+      }
+    });
+  }
+
   $("#addon-list li").click(function() {
     var url = $(this).attr("name");
     window.open(url);